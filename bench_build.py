@@ -0,0 +1,187 @@
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image, ImageDraw
+
+import grid_layout_bin_packing16 as gen
+
+# synthesizes archiGrad.io-like trees and times the whole generator on them (scan -> sprites -> data -> index.html):
+# a cold build from nothing and a rebuild with nothing changed, with peak RSS and output size per scale
+
+
+SCALES = [1000, 10000, 100000]
+GENERATOR = Path(__file__).with_name('grid_layout_bin_packing16.py')
+CORPUS_VERSION = 1
+OUTPUTS = ['spritesheets', gen.SHARD_DIR, 'data.json', 'data.bin', 'index.html']
+
+
+def make_image(path, size, rng):
+    # flat colour plus a couple of shapes: unique pixels per file (so dedupe doesn't collapse the corpus)
+    # while staying cheap to write
+    img = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(3):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = rng.randrange(x0, size[0] + 1), rng.randrange(y0, size[1] + 1)
+        draw.rectangle([x0, y0, x1, y1], fill=tuple(rng.randrange(256) for _ in range(3)))
+    img.save(path)
+
+def make_gif(path, size, frame_count, rng):
+    frames = []
+    color = tuple(rng.randrange(256) for _ in range(3))
+    for i in range(frame_count):
+        img = Image.new('RGB', size, color)
+        ImageDraw.Draw(img).ellipse([i * 4, i * 4, size[0] // 2 + i * 4, size[1] // 2 + i * 4], fill=(255, 255, 255))
+        frames.append(img)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+def make_corpus(path, spec):
+    rng = random.Random(spec['seed'])
+    leaves = []
+
+    def add_folder(folder, level):
+        folder.mkdir(parents=True, exist_ok=True)
+        if level > 0 and rng.random() < spec['marker_ratio']:
+            (folder / rng.choice(['.no_accum', '.stop_accum'])).touch()
+        if rng.random() < spec['text_ratio']:
+            (folder / 'normaltext.html').write_text(f'<p>{folder.name}</p>\n')
+        if level == spec['depth']:
+            leaves.append(folder)
+            if rng.random() < spec['marker_ratio']:
+                (folder / '.grid_layout').write_text(f"{rng.randint(1, 4)}x{rng.randint(1, 3)}\n")
+            return
+        for i in range(spec['fanout']):
+            add_folder(folder / (f'project{i}' if level + 1 == spec['depth'] else f'folder{i}'), level + 1)
+
+    add_folder(path / 'archiGrad.io', 0)
+    for idx in range(spec['images']):
+        folder = leaves[idx % len(leaves)]
+        size = (rng.randint(spec['min_size'], spec['max_size']), rng.randint(spec['min_size'], spec['max_size']))
+        if rng.random() < spec['gif_ratio']:
+            make_gif(folder / f'anim_{idx}.gif', size, rng.randint(2, spec['gif_frames']), rng)
+        else:
+            make_image(folder / f"img_{idx}.{rng.choice(spec['formats'])}", size, rng)
+    (path / 'corpus.json').write_text(json.dumps(spec))
+
+def corpus_for(workdir, spec):
+    # corpora are kept between runs, keyed by everything that shapes them
+    key = hashlib.sha1(json.dumps({**spec, 'version': CORPUS_VERSION}, sort_keys=True).encode()).hexdigest()[:10]
+    path = Path(workdir) / f"corpus_{spec['images']}_{key}"
+    if not (path / 'corpus.json').exists():
+        shutil.rmtree(path, ignore_errors=True)
+        start = time.perf_counter()
+        make_corpus(path, spec)
+        print(f"Generated {spec['images']} images in {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+def clean(path):
+    for name in OUTPUTS + [gen.SPRITE_CACHE_DIR, gen.MANIFEST_FILE]:
+        target = path / name
+        if target.is_dir():
+            shutil.rmtree(target)
+        elif target.exists():
+            target.unlink()
+
+def run_generator(path, extra_args):
+    # wait4 gives the rusage of this one child (and the pool workers it waited for), so peak RSS isn't
+    # polluted by earlier scales the way RUSAGE_CHILDREN would be
+    start = time.perf_counter()
+    with open(path / 'bench.log', 'w') as log:
+        proc = subprocess.Popen([sys.executable, str(GENERATOR.resolve())] + extra_args, cwd=path, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            proc.wait()
+            peak_rss = None
+    seconds = time.perf_counter() - start
+    if proc.returncode:
+        sys.exit(f"generator failed in {path}, see {path / 'bench.log'}")
+    return seconds, peak_rss
+
+def output_size(path):
+    size = 0
+    for name in OUTPUTS:
+        target = path / name
+        files = target.rglob('*') if target.is_dir() else [target]
+        size += sum(f.stat().st_size for f in files if f.is_file() and f.suffix not in ('.gz', '.br'))
+    return size
+
+def stage_times(path):
+    report = path / gen.BUILD_REPORT if gen.BUILD_REPORT else None
+    if report is None or not report.exists():
+        return {}
+    return {stage: entry['wall'] for stage, entry in json.loads(report.read_text())['stages'].items()}
+
+def fmt_delta(value, old):
+    if value is None or not old:
+        return ''
+    return f' ({(value - old) / old:+.0%})'
+
+def run(args):
+    baseline = {}
+    if args.baseline:
+        for row in json.loads(Path(args.baseline).read_text())['results']:
+            baseline[(row['images'], row['run'])] = row
+
+    extra_args = ['--jobs', str(args.jobs)] if args.jobs else []
+    results = []
+    print(f"{'images':>7} {'run':<5} {'seconds':>16} {'peak RSS MB':>18} {'output MB':>16} {'sheets':>6}")
+    for images in args.scales:
+        spec = {
+            'images': images, 'depth': args.depth, 'fanout': args.fanout,
+            'min_size': args.min_size, 'max_size': args.max_size, 'formats': args.formats,
+            'gif_ratio': args.gif_ratio, 'gif_frames': args.gif_frames,
+            'marker_ratio': args.marker_ratio, 'text_ratio': args.text_ratio, 'seed': args.seed
+        }
+        path = corpus_for(args.workdir, spec)
+        clean(path)
+        for run_name in ['cold', 'warm']:
+            seconds, peak_rss = run_generator(path, extra_args)
+            row = {
+                'images': images, 'run': run_name, 'seconds': round(seconds, 3), 'peak_rss': peak_rss,
+                'output_bytes': output_size(path), 'sheets': len([f for f in (path / 'spritesheets').glob('sprites_*') if '@' not in f.name]),
+                'stages': stage_times(path)
+            }
+            results.append(row)
+            old = baseline.get((images, run_name), {})
+            rss_mb = peak_rss / 2**20 if peak_rss else 0
+            print(f"{images:>7} {run_name:<5} {seconds:>9.2f}{fmt_delta(seconds, old.get('seconds')):>7} "
+                  f"{rss_mb:>11.0f}{fmt_delta(peak_rss, old.get('peak_rss')):>7} "
+                  f"{row['output_bytes'] / 2**20:>9.1f}{fmt_delta(row['output_bytes'], old.get('output_bytes')):>7} {row['sheets']:>6}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({'spec': vars(args), 'results': results}, indent=1) + '\n')
+        print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default=','.join(map(str, SCALES)), help='comma separated image counts')
+    parser.add_argument('--depth', type=int, default=3, help='folder levels below archiGrad.io')
+    parser.add_argument('--fanout', type=int, default=6, help='subfolders per folder')
+    parser.add_argument('--min-size', type=int, default=64, help='smallest source image side')
+    parser.add_argument('--max-size', type=int, default=1024, help='largest source image side')
+    parser.add_argument('--formats', default='jpg,png', help='comma separated still image formats')
+    parser.add_argument('--gif-ratio', type=float, default=0.05, help='share of images that are animated gifs')
+    parser.add_argument('--gif-frames', type=int, default=8, help='max frames per gif')
+    parser.add_argument('--marker-ratio', type=float, default=0.2, help='share of folders with a .grid_layout/.no_accum/.stop_accum marker')
+    parser.add_argument('--text-ratio', type=float, default=0.1, help='share of folders with an html text')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=0, help='passed to the generator, 0 keeps its default')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'grid_layout_bench'), help='where corpora are generated and kept')
+    parser.add_argument('--output', default='bench_build.json', help='results file')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+    args.scales = [int(v) for v in args.scales.split(',')]
+    args.formats = args.formats.split(',')
+
+    run(args)
@@ -0,0 +1,73 @@
+from pathlib import Path
+import argparse
+import tempfile
+import time
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+import grid_layout_bin_packing16 as gen
+
+# compares the old full decode + LANCZOS path with draft/reducing_gap per format:
+# time, decoded pixels (the peak buffer the decoder has to allocate) and how far the sprites differ
+
+
+FORMATS = ['jpg', 'png', 'webp', 'gif']
+
+
+def make_sample(path, size):
+    img = Image.new('RGB', size, (20, 20, 255))
+    draw = ImageDraw.Draw(img)
+    for i in range(0, size[0], 97):
+        draw.line([(i, 0), (size[0] - i, size[1])], fill=(255, i % 256, 0), width=9)
+    draw.ellipse([size[0] // 4, size[1] // 4, size[0] * 3 // 4, size[1] * 3 // 4], fill=(0, 200, 80))
+    img.save(path)
+
+def old_path(path):
+    img = Image.open(path).convert('RGBA')
+    decoded = img.width * img.height
+    w, h = img.size
+    scale = gen.SPRITE_SIZE / max(w, h)
+    return img.resize((int(w * scale), int(h * scale)), gen.RESIZE_METHOD), decoded
+
+def new_path(path):
+    img, source_size = gen.open_for_sprite(path)
+    decoded = img.width * img.height
+    return gen.load_resized(path), decoded
+
+def bench(fn, path, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result, decoded = fn(path)
+        best = min(best, time.perf_counter() - start)
+    return result, decoded, best
+
+def run(paths, repeat):
+    print(f"{'file':<28} {'old ms':>8} {'new ms':>8} {'speedup':>8} {'old Mpx':>8} {'new Mpx':>8} {'mean diff':>9} {'max diff':>8}")
+    for path in paths:
+        old_img, old_px, old_t = bench(old_path, path, repeat)
+        new_img, new_px, new_t = bench(new_path, path, repeat)
+        assert old_img.size == new_img.size, (old_img.size, new_img.size)
+        diff = ImageChops.difference(old_img, new_img)
+        mean_diff = sum(ImageStat.Stat(diff).mean[:3]) / 3
+        max_diff = max(high for low, high in diff.getextrema()[:3])
+        print(f"{Path(path).name:<28} {old_t * 1000:>8.1f} {new_t * 1000:>8.1f} {old_t / new_t:>7.1f}x "
+              f"{old_px / 1e6:>8.2f} {new_px / 1e6:>8.2f} {mean_diff:>9.2f} {max_diff:>8}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='images to benchmark, default is a synthetic sample per format')
+    parser.add_argument('--size', default='4000x3000', help='synthetic sample size')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.paths:
+        run(args.paths, args.repeat)
+    else:
+        size = tuple(int(v) for v in args.size.split('x'))
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for fmt in FORMATS:
+                path = Path(tmp) / f'sample_{size[0]}x{size[1]}.{fmt}'
+                make_sample(path, size)
+                paths.append(path)
+            run(paths, args.repeat)
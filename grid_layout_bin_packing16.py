@@ -1,8 +1,25 @@
 from pathlib import Path
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import argparse
+import filecmp
+import gzip
+import hashlib
+import io
 import json
+import math
+import os
+import sys
+import time
 from PIL import Image
 from natsort import natsorted
 
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
 # .stop_accom, .no_accum, .grid_layout
 
 
@@ -11,12 +28,23 @@ SPRITE_SIZE = 128
 SPRITE_PADDING = 0
 SPRITES_PER_ROW = SPRITESHEET_SIZE // SPRITE_SIZE
 SPRITES_PER_SHEET = SPRITES_PER_ROW * SPRITES_PER_ROW
+PACKING = 'maxrects'  # 'maxrects' packs sprites at their real size, 'grid' gives every sprite a SPRITE_SIZE cell
+SHEET_ASSIGNMENT = 'subtree'  # 'subtree' packs in tree order and keeps each folder on one sheet, 'global' packs in natsort order
+SHEET_REPORT_LIMIT = 10  # nodes listed in the sheets-per-node report
+PREVIEW_SIZE = 16  # px per image in the preview atlas the viewer draws from until sheets arrive, 0 = no preview
+SHEET_VARIANTS = [32, 64, 128, 256]  # sprite sizes of downscaled sheet copies the viewer picks from by zoom; sizes >= SPRITE_SIZE use the full sheet
 RESIZE_METHOD = Image.LANCZOS   #use Image.NEAREST for nearest neigbour algo, Image.LANCZOS for smooth interpolation
+RESIZE_REDUCING_GAP = 3.0  # box-reduce by an integer factor before RESIZE_METHOD, None = full-res resample (slow)
+JPEG_DRAFT = True  # let the JPEG decoder downscale by 1/2..1/8 while decoding
 SPRITESHEET_FORMAT = 'webp'
-WEBP_QUALITY = 100
-WEBP_METHOD = 0
+WEBP_QUALITY = 80  # 80/4 are what Pillow used before these were applied, so default sheets keep their size
+WEBP_METHOD = 4
 PNG_COMPRESS_LEVEL = 9
 PNG_OPTIMIZE = True
+SHEET_ENCODING = 'fixed'  # 'fixed' = WEBP_QUALITY/WEBP_METHOD, 'budget' = best quality within SHEET_BYTE_BUDGET, 'ssim' = smallest file with SSIM >= SSIM_FLOOR (needs numpy)
+SHEET_BYTE_BUDGET = 1024 * 1024  # bytes per sheet in 'budget' mode
+SSIM_FLOOR = 0.98  # mean 8x8 block SSIM of the premultiplied luma in 'ssim' mode
+ENCODE_SEARCH_METHODS = [4, 6]  # WebP methods tried per sheet in 'budget'/'ssim' mode, 6 is smallest but slowest
 
 SHARPEN = False
 SHARPEN_RADIUS = 2
@@ -27,6 +55,7 @@ GAUSSIAN_BLUR = False
 GAUSSIAN_BLUR_RADIUS = 2
 COLOR_TO_TRANSPARENT = 'blue'
 COLOR_THRESHOLD = 30
+COLOR_FEATHER = 0  # >0 fades alpha in over this many levels past COLOR_THRESHOLD instead of a hard cut
 
 DITHERING = False
 DITHER_MODE = 'custom_palette'
@@ -49,6 +78,39 @@ RANDOM_TEXTDIV_POSITION = False  # False = text always left, True = random based
 
 LOADINGSCREEN_IMG_INCREMENT = 50
 
+SCAN_WORKERS = 16  # threads listing folders in parallel, helps a lot on network mounts
+USE_SCAN_MANIFEST = True  # only re-list folders whose mtime changed since the last build
+MANIFEST_FILE = 'scan_manifest.json'
+MTIME_GRANULARITY = 2.0  # seconds; folders changed this close to their last listing are listed again (coarse mtimes on network mounts)
+SCAN_IGNORE = ['venv', '__pycache__', '.git', 'spritesheets', 'shards', 'sprite_cache', 'images', 'backup', 'geo']
+
+DEDUPLICATE_SPRITES = True  # pixel-identical images (after processing) share one slot and sprite record
+
+JOBS = os.cpu_count() or 1  # worker processes for decode/resize/filter, 1 = serial
+ENCODE_WORKERS = 2  # threads encoding finished sheets while the next one is packed, 0 = encode inline
+MEMORY_BUDGET = None  # MB for open sheets, source decodes and decoded sprites in flight, None = no limit; fewer encoders, decode workers and a shorter decode queue when tight
+WARM_CACHE_SIZE = 512  # MB of decoded sprites a Builder keeps between builds (watch mode), on top of MEMORY_BUDGET
+
+USE_SPRITE_CACHE = True  # reuse processed sprites keyed by source bytes + the settings that affect them
+SPRITE_CACHE_DIR = 'sprite_cache'
+STABLE_SLOTS = True  # sprites keep the slots of the last build (layout kept in SPRITE_CACHE_DIR), new images fill free space
+LAYOUT_FILE = 'layout.json'
+PREVIEW_MASTER_FILE = 'preview.png'  # lossless copy of the preview atlas, so it can be patched instead of rebuilt
+
+DATA_FORMAT = 'json'  # 'json' or 'binary' (single data.bin with typed-array columns, no sharding)
+SHARD_DATA = True  # split sprite records out of data.json into per-subtree files loaded on demand
+SHARD_SIZE = 2000  # max sprite records per shard file
+SHARD_DIR = 'shards'
+
+PRECOMPRESS = True  # write .gz (and .br when brotli is installed) next to data/html outputs
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+WATCH_INTERVAL = 1.0  # seconds between polls of the source tree in --watch mode
+
+BUILD_REPORT = 'build_report.json'  # per-stage wall/cpu time, throughput and bytes of every build, None to skip
+BUILD_REPORT_SLOWEST = 20  # slowest images listed in the report
+
 
 def apply_filter(img):
     if SHARPEN:
@@ -78,16 +140,24 @@ def apply_filter(img):
             'orange': (255, 165, 0),
             'purple': (128, 0, 128)
         }
-        target_r, target_g, target_b = colors[COLOR_TO_TRANSPARENT]
+        from PIL import ImageChops
+        target = colors[COLOR_TO_TRANSPARENT]
         img = img.convert('RGBA')
-        pixels = img.load()
-        for y in range(img.height):
-            for x in range(img.width):
-                r, g, b, a = pixels[x, y]
-                if (abs(r - target_r) < COLOR_THRESHOLD and 
-                    abs(g - target_g) < COLOR_THRESHOLD and 
-                    abs(b - target_b) < COLOR_THRESHOLD):
-                    pixels[x, y] = (r, g, b, 0)
+        r, g, b, a = img.split()
+        # per-band lookup tables instead of a python loop per pixel: the largest channel distance
+        # to the key colour (all three below the threshold <=> the max is), then a lut from that
+        # distance to an alpha factor, so the feathered edge costs the same as the hard key
+        distances = [band.point([abs(v - t) for v in range(256)]) for band, t in zip((r, g, b), target)]
+        distance = ImageChops.lighter(ImageChops.lighter(distances[0], distances[1]), distances[2])
+        key = []
+        for d in range(256):
+            if d < COLOR_THRESHOLD:
+                key.append(0)
+            elif COLOR_FEATHER > 0:
+                key.append(min(255, round(255 * (d - COLOR_THRESHOLD) / COLOR_FEATHER)))
+            else:
+                key.append(255)
+        img.putalpha(ImageChops.multiply(a, distance.point(key)))
     
     if DITHERING:
         dither_map = {
@@ -134,202 +204,1860 @@ def apply_filter(img):
     
     return img
 
-def resize_image(img):
-    w, h = img.size
+def sprite_dimensions(w, h):
     longest = max(w, h)
-    if longest != SPRITE_SIZE:
-        scale = SPRITE_SIZE / longest
-        new_w = int(w * scale)
-        new_h = int(h * scale)
-        img = img.resize((new_w, new_h), RESIZE_METHOD)
+    if longest == SPRITE_SIZE:
+        return w, h
+    scale = SPRITE_SIZE / longest
+    return int(w * scale), int(h * scale)
+
+def resize_image(img, source_size=None):
+    # source_size is the size before any decoder-level (draft) reduction, so the sprite
+    # dimensions don't drift by a pixel when the decoder already shrank the image
+    new_size = sprite_dimensions(*(source_size or img.size))
+    if new_size != img.size:
+        if img.mode == 'RGBA' and RESIZE_METHOD != Image.NEAREST:
+            # Image.resize premultiplies RGBA itself but drops reducing_gap on the way, so do it here
+            img = img.convert('RGBa').resize(new_size, RESIZE_METHOD, reducing_gap=RESIZE_REDUCING_GAP).convert('RGBA')
+        else:
+            img = img.resize(new_size, RESIZE_METHOD, reducing_gap=RESIZE_REDUCING_GAP)
     return img
 
-def scan_folder(path, ignore=['venv', '__pycache__', '.git', 'spritesheets', 'images', 'backup', 'geo']):
-    if path.name in ignore:
-        return None
-    
+def open_for_sprite(source):
+    # JPEG can decode straight at 1/2, 1/4 or 1/8 scale, so a multi-megapixel render
+    # never gets fully decoded just to end up 128px wide
+    img = Image.open(source)
+    source_size = img.size
+    if JPEG_DRAFT and img.format == 'JPEG':
+        img.draft('RGB', sprite_dimensions(*source_size))
+    return img, source_size
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.webp']
+MARKER_FILES = ['.grid_layout', '.no_accum', '.stop_accum']
+MANIFEST_VERSION = 1
+BINARY_MAGIC = 0x31444741  # 'AGD1'
+NO_STRING = 0xFFFFFFFF
+NO_PREVIEW = 0xFFFF
+LAYOUT_VERSION = 2
+SPRITE_CACHE_VERSION = 1  # bump when process_image/apply_filter change their output
+WORKER_SETTINGS = [
+    'SPRITE_SIZE', 'RESIZE_METHOD', 'RESIZE_REDUCING_GAP', 'JPEG_DRAFT', 'MAX_GIF_FRAMES',
+    'SHARPEN', 'SHARPEN_RADIUS', 'SHARPEN_PERCENT', 'SHARPEN_THRESHOLD',
+    'GAUSSIAN_BLUR', 'GAUSSIAN_BLUR_RADIUS', 'COLOR_TO_TRANSPARENT', 'COLOR_THRESHOLD', 'COLOR_FEATHER',
+    'DITHERING', 'DITHER_MODE', 'DITHER_METHOD', 'DITHER_COLORS', 'CUSTOM_PALETTE',
+    'USE_SPRITE_CACHE', 'SPRITE_CACHE_DIR'
+]
+
+
+def list_folder(path, ignore):
+    # one scandir per folder; DirEntry.is_dir()/is_file() reuse the d_type from readdir
+    listed = time.time_ns()
+    mtime = os.stat(path).st_mtime_ns
+    dirs = []
     images = []
     texts = []
-    children = []
+    markers = {}
+    entry_count = 0
+    with os.scandir(path) as it:
+        entries = list(it)
+    for entry in natsorted(entries, key=lambda x: (not x.is_dir(), x.name)):
+        entry_count += 1
+        if entry.name in MARKER_FILES:
+            markers[entry.name] = entry
+            continue
+        if entry.name in ignore:
+            continue
+        if entry.is_file():
+            suffix = os.path.splitext(entry.name)[1].lower()
+            if suffix in IMAGE_EXTENSIONS:
+                images.append(str(path / entry.name))
+            elif suffix == '.html':
+                texts.append(str(path / entry.name))
+        elif entry.is_dir():
+            dirs.append(str(path / entry.name))
+
     grid_layout = None
-    no_accum = False
-    stop_accum = False
-    
-    if path.is_dir():
-        grid_file = path / '.grid_layout'
-        if grid_file.exists():
-            grid_layout = grid_file.read_text().strip()
-        
-        no_accum_file = path / '.no_accum'
-        no_accum = no_accum_file.exists()
-        
-        stop_accum_file = path / '.stop_accum'
-        stop_accum = stop_accum_file.exists()
-            
-        for item in natsorted(path.iterdir(), key=lambda x: (not x.is_dir(), x.name)):
-            if item.name in ignore or item.name in ['.grid_layout', '.no_accum', '.stop_accum']:
-                continue
-            if item.is_file():
-                if item.suffix.lower() in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
-                    images.append(str(item.relative_to('.')))
-                elif item.suffix.lower() == '.html':
-                    texts.append(str(item.relative_to('.')))
-            elif item.is_dir():
-                child = scan_folder(item, ignore)
-                if child:
-                    children.append(child)
-        
-        all_images = images.copy()
-        all_texts = texts.copy()
-        for child in children:
-            all_images.extend(child['ai'])
-            if not child.get('na', False) and not child.get('sa', False):  # check both flags
-                all_texts.extend(child['at'])        
-        
+    grid_mtime = None
+    if '.grid_layout' in markers:
+        grid_layout = Path(markers['.grid_layout'].path).read_text().strip()
+        grid_mtime = markers['.grid_layout'].stat().st_mtime_ns
+
+    # the iterdir() walk did one is_dir() in the sort key and one is_file() per entry,
+    # a second is_dir() per folder entry, and is_dir() + 3 exists() per folder
+    stat_calls = 4 + 2 * entry_count + len(dirs)
+    # this listing: the folder stat and the .grid_layout stat. is_dir()/is_file() only stat an entry
+    # when the filesystem doesn't report its type (d_type), which can't be seen from here
+    new_stat_calls = 1 + (grid_mtime is not None)
+    return {
+        'mtime': mtime,
+        'listed': listed,
+        'dirs': dirs,
+        'images': images,
+        'texts': texts,
+        'grid_layout': grid_layout,
+        'grid_mtime': grid_mtime,
+        'no_accum': '.no_accum' in markers,
+        'stop_accum': '.stop_accum' in markers,
+        'stat_calls': stat_calls,
+        'new_stat_calls': new_stat_calls,
+        'entries': entry_count
+    }
 
-    
+def load_folder(path, ignore, cached):
+    # returns (listing, relisted, stat calls spent on checking the cached listing)
+    if not cached:
+        return list_folder(path, ignore), True, 0
+    # editing a .grid_layout in place doesn't touch the folder mtime, so check it separately.
+    # Like git's racily clean entries: a file added in the same timestamp tick as the listing leaves the
+    # mtime unchanged, so a listing taken within MTIME_GRANULARITY of the last change can't be trusted
+    newest = max(cached['mtime'], cached['grid_mtime'] or 0)
+    racy = cached.get('listed', 0) - newest < MTIME_GRANULARITY * 1e9
+    if not racy and cached['mtime'] == os.stat(path).st_mtime_ns:
+        if cached['grid_mtime'] is None:
+            return cached, False, 1
+        grid_file = path / '.grid_layout'
+        if grid_file.exists() and grid_file.stat().st_mtime_ns == cached['grid_mtime']:
+            return cached, False, 3
+    if racy:
+        return list_folder(path, ignore), True, 0
+    return list_folder(path, ignore), True, 3 if cached['grid_mtime'] is not None else 1
+
+def load_manifest(ignore):
+    try:
+        manifest = json.loads(Path(MANIFEST_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('ignore') != list(ignore):
+        return {}
+    return manifest['folders']
+
+def save_manifest(ignore, listings):
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'ignore': list(ignore), 'folders': listings}, f, separators=(',', ':'))
+
+def scan_folder(path, ignore=None):
+    if ignore is None:
+        ignore = SCAN_IGNORE
+    if path.name in ignore:
+        return None, [], []
+
+    manifest = load_manifest(ignore) if USE_SCAN_MANIFEST else {}
+    listings = {}
+    rescanned = 0
+    old_calls = new_calls = untyped = 0
+    level = [path]
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        while level:
+            results = list(executor.map(lambda p: load_folder(p, ignore, manifest.get(str(p))), level))
+            next_level = []
+            for folder, (listing, changed, check_calls) in zip(level, results):
+                listings[str(folder)] = listing
+                rescanned += changed
+                new_calls += check_calls
+                if changed:
+                    old_calls += listing['stat_calls']
+                    new_calls += listing['new_stat_calls']
+                    untyped += listing['entries']
+                next_level.extend(Path(d) for d in listing['dirs'])
+            level = next_level
+
+    # the old walk's count only covers the folders listed again, cached ones cost it nothing to skip
+    print(f"Scanned {len(listings)} folders ({rescanned} changed): {new_calls} stat calls "
+          f"(+{untyped} on filesystems without d_type), the old walk needed {old_calls} for the changed folders")
+
+    if USE_SCAN_MANIFEST and (rescanned or listings.keys() != manifest.keys()):
+        save_manifest(ignore, listings)
+
+    image_paths = []
+    text_paths = []
+    root = build_node(path, listings, image_paths, text_paths)
+    return root, image_paths, text_paths
+
+def add_range(ranges, start, end):
+    if start == end:
+        return
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = end
+    else:
+        ranges.append([start, end])
+
+def build_node(path, listings, image_paths, text_paths):
+    # images and texts go into flat tables in DFS order, so a node's aggregate is a [start, end)
+    # range; texts can have holes where a child has .no_accum/.stop_accum, so 'at' is a range list
+    listing = listings[str(path)]
+    image_start = len(image_paths)
+    image_paths.extend(listing['images'])
+    text_start = len(text_paths)
+    text_paths.extend(listing['texts'])
+    own_image_end = len(image_paths)
+    own_text_end = len(text_paths)
+    children = [build_node(Path(child_path), listings, image_paths, text_paths) for child_path in listing['dirs']]
+
+    all_texts = []
+    add_range(all_texts, text_start, own_text_end)
+    for child in children:
+        if not child.get('na', False) and not child.get('sa', False):  # check both flags
+            for start, end in child['at']:
+                add_range(all_texts, start, end)
+
+    has_images = len(image_paths) > image_start
+    has_texts = len(all_texts) > 0
     content_type = 'empty'
-    if all_images and all_texts:
+    if has_images and has_texts:
         content_type = 'mixed'
-    elif all_images:
+    elif has_images:
         content_type = 'images'
-    elif all_texts:
+    elif has_texts:
         content_type = 'text'
     
     result = {
         'name': path.name,
-        'path': str(path.relative_to('.')),
+        'path': str(path),
         'type': content_type,
         'children': children,
-        'ai': all_images,
+        'ai': [image_start, len(image_paths)],
         'at': all_texts,
-        'oi': images,
-        'ot': texts,
-        'na': no_accum,
-        'sa': stop_accum
+        'oi': [image_start, own_image_end],
+        'ot': [text_start, own_text_end],
+        'na': listing['no_accum'],
+        'sa': listing['stop_accum']
     }
     
-    if grid_layout:
-        result['grid_layout'] = grid_layout
+    if listing['grid_layout']:
+        result['grid_layout'] = listing['grid_layout']
     
     return result
 
-root = scan_folder(Path('.'))
-
-all_image_paths = []
-def collect_images(node):
-    all_image_paths.extend(node['oi'])
-    for child in node['children']:
-        collect_images(child)
-collect_images(root)
-
-all_image_paths = natsorted(all_image_paths)
-
-Path('spritesheets').mkdir(exist_ok=True)
-for file in Path('spritesheets').glob('*'):
-    file.unlink()
-
-sprite_data = {}
-sheet_idx = 0
-slot_idx = 0
-sheet = Image.new('RGBA', (SPRITESHEET_SIZE, SPRITESHEET_SIZE), (0, 0, 0, 0))
+def clock():
+    # thread CPU time, so encoder threads and the main loop don't bill each other
+    return time.perf_counter(), time.thread_time()
+
+def lap(timings, stage, mark):
+    # adds wall/cpu seconds since mark to timings[stage] and returns a new mark
+    now = clock()
+    if timings is not None:
+        wall, cpu = timings.get(stage, (0.0, 0.0))
+        timings[stage] = (wall + now[0] - mark[0], cpu + now[1] - mark[1])
+    return now
+
+def record_stage(report, stage, wall, cpu, items=0, bytes_in=0, bytes_out=0):
+    if report is None:
+        return
+    entry = report['stages'].setdefault(stage, {'wall': 0.0, 'cpu': 0.0, 'items': 0, 'bytes_in': 0, 'bytes_out': 0})
+    entry['wall'] += wall
+    entry['cpu'] += cpu
+    entry['items'] += items
+    entry['bytes_in'] += bytes_in
+    entry['bytes_out'] += bytes_out
+
+def record_image(report, img_path, frames, hit, timings):
+    if report is None:
+        return
+    # source bytes go to the first stage that read them, decoded sprite bytes to the last
+    # stage that produced them
+    size = os.path.getsize(img_path)
+    pixels = sum(frame.width * frame.height * 4 for frame in frames)
+    first = next((s for s in ('read', 'decode') if s in timings), None)
+    last = 'sprite_cache' if hit else next((s for s in ('apply_filter', 'resize') if s in timings), None)
+    for stage, (wall, cpu) in timings.items():
+        record_stage(report, stage, wall, cpu, 1,
+                     size if stage == first else 0, pixels if stage == last else 0)
+    report['images'].append((sum(wall for wall, cpu in timings.values()), img_path, hit, timings))
+
+def load_resized(source, timings=None):
+    mark = clock()
+    img, source_size = open_for_sprite(source)
+    img.load()
+    # RGB/L resize the same before or after going to RGBA, so only convert the full-size
+    # image when the mode needs it (palette, 16 bit, cmyk...)
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGBA')
+    mark = lap(timings, 'decode', mark)
+    img = resize_image(img, source_size)
+    img = img.convert('RGBA')
+    lap(timings, 'resize', mark)
+    return img
 
-for idx, img_path in enumerate(all_image_paths):
-    is_gif = img_path.lower().endswith('.gif')
-    
-    if is_gif:
-        gif = Image.open(img_path)
+def process_image(img_path, source=None, timings=None):
+    source = source or img_path
+    if img_path.lower().endswith('.gif'):
+        mark = clock()
+        gif = Image.open(source)
         frame_count = min(gif.n_frames,MAX_GIF_FRAMES) 
-        
-        if slot_idx + frame_count > SPRITES_PER_SHEET:
-            if slot_idx > 0:
-                sheet.save(f'spritesheets/sprites_{sheet_idx}.{SPRITESHEET_FORMAT}')
-            sheet_idx += 1
-            slot_idx = 0
-            sheet = Image.new('RGBA', (SPRITESHEET_SIZE, SPRITESHEET_SIZE), (0, 0, 0, 0))
-        
-        start_idx = slot_idx
+        frames = []
         for frame_idx in range(frame_count):
             gif.seek(frame_idx)
             frame = gif.convert('RGBA')
+            mark = lap(timings, 'decode', mark)
             frame = resize_image(frame)
-            frame = apply_filter(frame)           
- 
-            col = slot_idx % SPRITES_PER_ROW
-            row = slot_idx // SPRITES_PER_ROW
-            x = col * SPRITE_SIZE + SPRITE_PADDING
-            y = row * SPRITE_SIZE + SPRITE_PADDING
-            sheet.paste(frame, (x, y))
-            slot_idx += 1
-        
-        sprite_data[img_path] = {
-            'ss': f'spritesheets/sprites_{sheet_idx}.{SPRITESHEET_FORMAT}',
-            'si': start_idx,
-            'fc': frame_count,
-            'anim': True,
-            'w': SPRITE_SIZE,
-            'h': SPRITE_SIZE,
-            'gi': idx,
-            'path': img_path
+            mark = lap(timings, 'resize', mark)
+            frame = apply_filter(frame)
+            mark = lap(timings, 'apply_filter', mark)
+            frames.append(frame)
+        return frames
+
+    img = load_resized(source, timings)
+    mark = clock()
+    img = apply_filter(img)
+    lap(timings, 'apply_filter', mark)
+    return [img]
+
+def sprite_settings_key(img_path):
+    # only the settings that actually change this image's pixels, so toggling e.g. DITHER_COLORS
+    # while DITHERING is off, or MAX_GIF_FRAMES for a png, doesn't invalidate anything
+    settings = [SPRITE_CACHE_VERSION, SPRITE_SIZE, RESIZE_METHOD]
+    if RESIZE_REDUCING_GAP:
+        settings += ['reducing_gap', RESIZE_REDUCING_GAP]
+    if img_path.lower().endswith('.gif'):
+        settings += ['gif', MAX_GIF_FRAMES]
+    if JPEG_DRAFT and img_path.lower().endswith(('.jpg', '.jpeg')):
+        settings.append('draft')
+    if SHARPEN:
+        settings += ['sharpen', SHARPEN_RADIUS, SHARPEN_PERCENT, SHARPEN_THRESHOLD]
+    if GAUSSIAN_BLUR:
+        settings += ['blur', GAUSSIAN_BLUR_RADIUS]
+    if COLOR_TO_TRANSPARENT:
+        settings += ['transparent', COLOR_TO_TRANSPARENT, COLOR_THRESHOLD]
+        if COLOR_FEATHER > 0:
+            settings += ['feather', COLOR_FEATHER]
+    if DITHERING:
+        settings += ['dither', DITHER_MODE, DITHER_METHOD]
+        if DITHER_MODE == 'color_reduce':
+            settings.append(DITHER_COLORS)
+        elif DITHER_MODE == 'custom_palette':
+            settings += CUSTOM_PALETTE
+    return repr(settings)
+
+def read_cached_frames(cache_path):
+    # frames are stacked vertically in one png, the frame count is kept in a text chunk
+    strip = Image.open(cache_path)
+    frame_count = int(strip.text['frames'])
+    strip = strip.convert('RGBA')
+    frame_h = strip.height // frame_count
+    return [strip.crop((0, i * frame_h, strip.width, (i + 1) * frame_h)) for i in range(frame_count)]
+
+def write_cached_frames(cache_path, frames):
+    from PIL.PngImagePlugin import PngInfo
+    strip = Image.new('RGBA', (frames[0].width, frames[0].height * len(frames)))
+    for i, frame in enumerate(frames):
+        strip.paste(frame, (0, i * frames[0].height))
+    info = PngInfo()
+    info.add_text('frames', str(len(frames)))
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    strip.save(tmp_path, format='PNG', pnginfo=info, compress_level=1)
+    os.replace(tmp_path, cache_path)
+
+def decode_error(img_path, error):
+    # sources are decoded from the bytes the cache key was made of, so Pillow's messages name a BytesIO
+    if isinstance(error, Image.UnidentifiedImageError):
+        return Image.UnidentifiedImageError(f"cannot identify image file {img_path!r}")
+    return OSError(f"{img_path}: {error}")
+
+def cached_process_image(img_path, timings=None):
+    if not USE_SPRITE_CACHE:
+        try:
+            return process_image(img_path, timings=timings), False
+        except (OSError, SyntaxError, ValueError) as e:
+            raise decode_error(img_path, e) from e
+    mark = clock()
+    data = Path(img_path).read_bytes()
+    key = hashlib.sha256(data + sprite_settings_key(img_path).encode()).hexdigest()
+    cache_path = Path(SPRITE_CACHE_DIR) / key[:2] / f'{key}.png'
+    mark = lap(timings, 'read', mark)
+    if cache_path.exists():
+        frames = read_cached_frames(cache_path)
+        lap(timings, 'sprite_cache', mark)
+        return frames, True
+    try:
+        frames = process_image(img_path, io.BytesIO(data), timings)
+    except (OSError, SyntaxError, ValueError) as e:
+        raise decode_error(img_path, e) from e
+    mark = clock()
+    write_cached_frames(cache_path, frames)
+    lap(timings, 'sprite_cache', mark)
+    return frames, False
+
+def timed_process_image(img_path):
+    # pool entry point: the per-stage timings and the worker's peak RSS so far travel back with the frames
+    timings = {}
+    frames, hit = cached_process_image(img_path, timings)
+    return frames, hit, timings, peak_rss()
+
+class WarmCache:
+    # decoded sprites a long-lived Builder keeps between builds, keyed by path and (mtime, size); the least
+    # recently used are dropped once they add up to more than WARM_CACHE_SIZE MB
+    def __init__(self):
+        self.entries = {}
+        self.size = 0
+
+    def get(self, img_path):
+        st = os.stat(img_path)
+        entry = self.entries.pop(img_path, None)
+        if entry is None:
+            return None
+        if entry[0] != (st.st_mtime_ns, st.st_size):
+            self.size -= entry[2]
+            return None
+        self.entries[img_path] = entry
+        return entry[1]
+
+    def put(self, img_path, frames):
+        st = os.stat(img_path)
+        old = self.entries.pop(img_path, None)
+        if old is not None:
+            self.size -= old[2]
+        size = sum(frame.width * frame.height * len(frame.getbands()) for frame in frames)
+        self.entries[img_path] = ((st.st_mtime_ns, st.st_size), frames, size)
+        self.size += size
+        while self.size > WARM_CACHE_SIZE * 1024 * 1024:
+            self.size -= self.entries.pop(next(iter(self.entries)))[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+def load_frames(img_path, warm_cache, timings=None):
+    if warm_cache is None:
+        return cached_process_image(img_path, timings)
+    frames = warm_cache.get(img_path)
+    if frames is not None:
+        return frames, True
+    frames, hit = cached_process_image(img_path, timings)
+    warm_cache.put(img_path, frames)
+    return frames, hit
+
+def worker_settings():
+    return {name: globals()[name] for name in WORKER_SETTINGS}
+
+def init_worker(settings):
+    # workers started with spawn/forkserver re-import the module with its defaults
+    globals().update(settings)
+
+def sprite_bytes(img_path):
+    # upper bound of the decoded frames one image turns into
+    frames = MAX_GIF_FRAMES if img_path.lower().endswith('.gif') else 1
+    return SPRITE_SIZE * SPRITE_SIZE * 4 * frames
+
+def bounded_map(executor, img_paths, in_flight):
+    # like executor.map, but results the parent hasn't consumed yet never add up to more than in_flight bytes
+    futures = []
+    queued = 0
+    for img_path in img_paths:
+        size = sprite_bytes(img_path)
+        while futures and queued + size > in_flight:
+            future, done = futures.pop(0)
+            queued -= done
+            yield future.result()
+        futures.append((executor.submit(timed_process_image, img_path), size))
+        queued += size
+    for future, done in futures:
+        yield future.result()
+
+def iter_frames(all_image_paths, warm_cache, jobs, report=None, in_flight=None, pool=None):
+    # workers only decode/resize/filter; results come back in input order so the
+    # parent's slot assignment and pasting stay identical to a serial run
+    if jobs <= 1 or len(all_image_paths) < 2:
+        for img_path in all_image_paths:
+            timings = {}
+            frames, hit = load_frames(img_path, warm_cache, timings)
+            record_image(report, img_path, frames, hit, timings)
+            yield frames, hit
+        return
+
+    # warm hits are taken out up front, sprites put in below may push them out of the cache
+    pending = []
+    warm = {}
+    for img_path in all_image_paths:
+        frames = warm_cache.get(img_path) if warm_cache is not None else None
+        if frames is None:
+            pending.append(img_path)
+        else:
+            warm[img_path] = frames
+
+    # a pool passed in (Builder) outlives this build, otherwise one is started just for it
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(worker_settings(),))
+    else:
+        pool = nullcontext(pool)
+    with pool as executor:
+        if in_flight is None:
+            chunksize = max(1, len(pending) // (jobs * 8))
+            results = executor.map(timed_process_image, pending, chunksize=chunksize)
+        else:
+            results = bounded_map(executor, pending, in_flight)
+        for img_path in all_image_paths:
+            if img_path in warm:
+                frames = warm.pop(img_path)
+                record_image(report, img_path, frames, True, {})
+                yield frames, True
+                continue
+            frames, hit, timings, worker_peak = next(results)
+            record_image(report, img_path, frames, hit, timings)
+            if report is not None and worker_peak:
+                report['peak_rss']['workers'] = max(report['peak_rss'].get('workers', 0), worker_peak)
+            if warm_cache is not None:
+                warm_cache.put(img_path, frames)
+            yield frames, hit
+
+class GridPacker:
+    # fixed SPRITE_SIZE cells in reading order, the original layout
+    def __init__(self, width, height):
+        self.cols = width // SPRITE_SIZE
+        self.capacity = self.cols * (height // SPRITE_SIZE)
+        self.taken = set()
+        self.next = 0
+
+    def insert(self, w, h):
+        while self.next in self.taken:
+            self.next += 1
+        if self.next >= self.capacity:
+            return None
+        cell = self.next
+        self.taken.add(cell)
+        return cell % self.cols * SPRITE_SIZE, cell // self.cols * SPRITE_SIZE
+
+    def place(self, x, y, w, h):
+        self.taken.add(y // SPRITE_SIZE * self.cols + x // SPRITE_SIZE)
+
+    def is_empty(self):
+        return not self.taken
+
+    def copy(self):
+        packer = GridPacker.__new__(GridPacker)
+        packer.__dict__.update(self.__dict__)
+        packer.taken = set(self.taken)
+        return packer
+
+    def state(self):
+        return {'taken': sorted(self.taken), 'next': self.next}
+
+    def load_state(self, state):
+        self.taken = set(state['taken'])
+        self.next = state['next']
+
+class MaxRectsPacker:
+    # maximal free rectangles with best-short-side-fit, so sprites sit at their real size
+    # and later small sprites backfill the holes left by earlier ones
+    def __init__(self, width, height):
+        self.free = [(0, 0, width, height)]
+        self.used = 0
+
+    def insert(self, w, h):
+        best = None
+        best_fit = None
+        for fx, fy, fw, fh in self.free:
+            if w <= fw and h <= fh:
+                fit = (min(fw - w, fh - h), max(fw - w, fh - h))
+                if best_fit is None or fit < best_fit:
+                    best = (fx, fy)
+                    best_fit = fit
+        if best is not None:
+            self.place(best[0], best[1], w, h)
+        return best
+
+    def place(self, x, y, w, h):
+        kept = []
+        split = []
+        for free in self.free:
+            fx, fy, fw, fh = free
+            if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+                kept.append(free)
+                continue
+            if x > fx:
+                split.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                split.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                split.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                split.append((fx, y + h, fw, fy + fh - y - h))
+
+        # untouched rects can't contain each other, so only the new ones need pruning
+        pruned = []
+        for i, rect in enumerate(split):
+            others = kept + pruned + split[i + 1:]
+            if not any(contains(other, rect) for other in others):
+                pruned.append(rect)
+        self.free = kept + pruned
+        self.used += 1
+
+    def is_empty(self):
+        return self.used == 0
+
+    def copy(self):
+        packer = MaxRectsPacker.__new__(MaxRectsPacker)
+        packer.free = list(self.free)
+        packer.used = self.used
+        return packer
+
+    def state(self):
+        return {'free': self.free, 'used': self.used}
+
+    def load_state(self, state):
+        self.free = [tuple(rect) for rect in state['free']]
+        self.used = state['used']
+
+def contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            outer[0] + outer[2] >= inner[0] + inner[2] and outer[1] + outer[3] >= inner[1] + inner[3])
+
+def new_packer():
+    if PACKING == 'grid':
+        return GridPacker(SPRITESHEET_SIZE, SPRITESHEET_SIZE)
+    return MaxRectsPacker(SPRITESHEET_SIZE, SPRITESHEET_SIZE)
+
+def sheet_variants():
+    # variants are the full sheet box-reduced by an integer factor, so every sprite rect maps to the same UVs
+    return [size for size in SHEET_VARIANTS if size < SPRITE_SIZE and SPRITE_SIZE % size == 0]
+
+def variant_path(sheet_path, size):
+    stem, ext = os.path.splitext(sheet_path)
+    return f'{stem}@{size}{ext}'
+
+def sheet_files(sheet_path, variants=True):
+    paths = [sheet_path]
+    if variants:
+        paths += [variant_path(sheet_path, size) for size in sheet_variants()]
+    return paths
+
+def encode_options(quality=None, method=None):
+    # settings are read here rather than as defaults, so configured() overrides apply
+    if SPRITESHEET_FORMAT == 'webp':
+        quality = WEBP_QUALITY if quality is None else quality
+        method = WEBP_METHOD if method is None else method
+        return {'quality': quality, 'method': method}
+    if SPRITESHEET_FORMAT == 'png':
+        return {'compress_level': PNG_COMPRESS_LEVEL, 'optimize': PNG_OPTIMIZE}
+    return {}
+
+def encode_image(img, options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=Image.registered_extensions()['.' + SPRITESHEET_FORMAT], **options)
+    return buffer.getvalue()
+
+def ssim_reference(img):
+    # premultiplied luma, so colour hidden under alpha 0 doesn't count, plus the 8x8 blocks that show anything
+    try:
+        import numpy as np
+    except ImportError:
+        raise SystemExit("SHEET_ENCODING = 'ssim' needs numpy (pip install numpy)")
+    img = img.convert('RGBA')
+    luma = np.asarray(Image.merge('RGB', img.convert('RGBa').split()[:3]).convert('L'), dtype=np.float64)
+    h = luma.shape[0] // 8 * 8
+    w = luma.shape[1] // 8 * 8
+    alpha = np.asarray(img.getchannel('A'))[:h, :w]
+    visible = alpha.reshape(h // 8, 8, w // 8, 8).max(axis=(1, 3)) > 0
+    return luma[:h, :w].reshape(h // 8, 8, w // 8, 8), visible
+
+def block_ssim(reference, img):
+    import numpy as np
+    x, visible = reference
+    y = ssim_reference(img)[0]
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mx = x.mean(axis=(1, 3))
+    my = y.mean(axis=(1, 3))
+    vx = x.var(axis=(1, 3))
+    vy = y.var(axis=(1, 3))
+    cov = (x * y).mean(axis=(1, 3)) - mx * my
+    ssim = (2 * mx * my + c1) * (2 * cov + c2) / ((mx ** 2 + my ** 2 + c1) * (vx + vy + c2))
+    return float(ssim[visible].mean()) if visible.any() else 1.0
+
+def search_encoding(sheet):
+    # returns (encoded bytes, options, ssim or None); binary search over quality for each method,
+    # assuming size and SSIM grow with quality
+    if SHEET_ENCODING == 'fixed' or SPRITESHEET_FORMAT != 'webp':
+        options = encode_options()
+        return encode_image(sheet, options), options, None
+
+    reference = ssim_reference(sheet) if SHEET_ENCODING == 'ssim' else None
+    best = None
+    for method in ENCODE_SEARCH_METHODS:
+        low, high = 0, 100
+        found = None
+        while low <= high:
+            quality = (low + high) // 2
+            options = encode_options(quality, method)
+            data = encode_image(sheet, options)
+            if SHEET_ENCODING == 'ssim':
+                score = block_ssim(reference, Image.open(io.BytesIO(data)))
+                ok = score >= SSIM_FLOOR
+            else:
+                score = None
+                ok = len(data) <= SHEET_BYTE_BUDGET
+            if ok:
+                found = (data, options, score)
+            # budget: look for a higher quality that still fits, ssim: for a lower one that still passes
+            if ok == (SHEET_ENCODING == 'budget'):
+                low = quality + 1
+            else:
+                high = quality - 1
+        if found is None:
+            # nothing meets the target, settle for the closest end of the range
+            options = encode_options(0 if SHEET_ENCODING == 'budget' else 100, method)
+            data = encode_image(sheet, options)
+            score = block_ssim(reference, Image.open(io.BytesIO(data))) if reference else None
+            found = (data, options, score)
+        if SHEET_ENCODING == 'budget':
+            key = (-found[1]['quality'], len(found[0]))
+        else:
+            key = (len(found[0]),)
+        if best is None or key < best[0]:
+            best = (key, found)
+    return best[1]
+
+def save_sheet(sheet, sheet_path, sheet_hashes, variants=True):
+    # unchanged sheets keep their file (and browser cache entry) untouched
+    # returns (path, encode seconds or None if unchanged, cpu seconds, sheet bytes, variant bytes,
+    # pixels encoded, options, ssim)
+    start = clock()
+    # hashed in bands, tobytes() of the whole sheet would be one more sheet-sized copy
+    digest = hashlib.sha1()
+    for y in range(0, sheet.height, 256):
+        digest.update(sheet.crop((0, y, sheet.width, min(y + 256, sheet.height))).tobytes())
+    digest = digest.hexdigest()
+    paths = sheet_files(sheet_path, variants)
+    if sheet_hashes.get(sheet_path) == digest and all(Path(path).exists() for path in paths):
+        return sheet_path, None, 0, 0, 0, 0, None, None
+    data, options, ssim = search_encoding(sheet)
+    Path(sheet_path).write_bytes(data)
+    pixels = sheet.width * sheet.height
+    if len(paths) > 1:
+        # variants reuse the settings chosen for the full sheet
+        premultiplied = sheet.convert('RGBa')
+        for size, path in zip(sheet_variants(), paths[1:]):
+            variant = premultiplied.reduce(SPRITE_SIZE // size).convert('RGBA')
+            variant.save(path, **options)
+            pixels += variant.width * variant.height
+    sheet_hashes[sheet_path] = digest
+    variant_bytes = sum(os.path.getsize(path) for path in paths[1:])
+    end = clock()
+    return sheet_path, end[0] - start[0], end[1] - start[1], len(data), variant_bytes, pixels, options, ssim
+
+def preview_path():
+    return f'spritesheets/preview.{SPRITESHEET_FORMAT}'
+
+def image_groups(image_paths):
+    # runs of images from the same folder, packed together in 'subtree' mode
+    groups = []
+    for img_path in image_paths:
+        if SHEET_ASSIGNMENT == 'subtree' and groups and os.path.dirname(groups[-1][-1]) == os.path.dirname(img_path):
+            groups[-1].append(img_path)
+        else:
+            groups.append([img_path])
+    return groups
+
+def packed_size(w, h):
+    # a sprite's rect on the sheet: padded, and with variants rounded up to the largest reduce factor. Rects
+    # then start on that grid, so no box a variant is reduced from straddles two sprites
+    variants = sheet_variants()
+    align = SPRITE_SIZE // min(variants) if variants else 1
+    return -(-(w + 2 * SPRITE_PADDING) // align) * align, -(-(h + 2 * SPRITE_PADDING) // align) * align
+
+def fits(packer, sizes):
+    trial = packer.copy()
+    return all(trial.insert(*packed_size(w, h)) for w, h in sizes)
+
+def slot_key(img_path, frames, is_gif):
+    # copies of a project ("test (copy)" etc.) map to the same key and share the first copy's slots
+    content = hashlib.sha1()
+    for frame in frames:
+        content.update(repr(frame.size).encode())
+        content.update(frame.tobytes())
+    key = ('g' if is_gif else 's') + content.hexdigest()
+    return key if DEDUPLICATE_SPRITES else f'{key}:{img_path}'
+
+def unique_sprite_frames(frames, is_gif):
+    # hold frames (identical after resize/filter) share one slot, frame_order maps frame -> unique frame
+    if not is_gif:
+        return frames[:1], [0]
+    unique_frames = []
+    frame_keys = {}
+    frame_order = []
+    for frame in frames:
+        key = (frame.size, hashlib.sha1(frame.tobytes()).digest())
+        if key not in frame_keys:
+            frame_keys[key] = len(unique_frames)
+            unique_frames.append(frame)
+        frame_order.append(frame_keys[key])
+    return unique_frames, frame_order
+
+def slot_positions(slot):
+    if slot.get('anim'):
+        return list(dict.fromkeys(tuple(pos) for pos in slot['fr']))
+    return [(slot['x'], slot['y'])]
+
+def layout_settings():
+    # anything that moves or repaints sprites invalidates the stored layout
+    settings = [LAYOUT_VERSION, SPRITESHEET_SIZE, SPRITE_SIZE, SPRITE_PADDING, PACKING, SPRITESHEET_FORMAT,
+                PREVIEW_SIZE, sheet_variants(), DEDUPLICATE_SPRITES] + [globals()[name] for name in WORKER_SETTINGS]
+    return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+def encoding_settings():
+    return repr([SHEET_ENCODING, WEBP_QUALITY, WEBP_METHOD, PNG_COMPRESS_LEVEL, PNG_OPTIMIZE,
+                 SHEET_BYTE_BUDGET, SSIM_FLOOR, ENCODE_SEARCH_METHODS])
+
+def load_layout():
+    try:
+        layout = json.loads(Path(SPRITE_CACHE_DIR, LAYOUT_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+    if layout.get('settings') != layout_settings():
+        return {}
+    if PREVIEW_SIZE:
+        # the lossless preview master is needed to repaint the preview without decoding every image
+        try:
+            layout['preview'] = Image.open(Path(SPRITE_CACHE_DIR, PREVIEW_MASTER_FILE)).convert('RGBA')
+        except (FileNotFoundError, OSError):
+            return {}
+    return layout
+
+def save_layout(layout, preview):
+    Path(SPRITE_CACHE_DIR).mkdir(exist_ok=True)
+    if preview is not None:
+        preview.save(Path(SPRITE_CACHE_DIR, PREVIEW_MASTER_FILE))
+    with open(Path(SPRITE_CACHE_DIR, LAYOUT_FILE), 'w') as f:
+        json.dump(layout, f, separators=(',', ':'))
+
+def decode_bytes(img_path):
+    # what one image costs while it is turned into a sprite: the decoded source (after the JPEG draft
+    # shrink) and the RGBA copy made from it
+    img, source_size = open_for_sprite(img_path)
+    with img:
+        return img.width * img.height * 4 * 2
+
+def largest_decode(img_paths):
+    if not img_paths:
+        return 0
+    with ThreadPoolExecutor(SCAN_WORKERS) as executor:
+        return max(executor.map(decode_bytes, img_paths))
+
+def decode_workers(jobs, in_flight, decode):
+    # returns (decode workers, bytes left for decoded sprites in flight): every worker may be holding the
+    # largest source at once, that comes out of in_flight first
+    if in_flight is None or not decode:
+        return jobs, in_flight
+    largest = SPRITE_SIZE * SPRITE_SIZE * 4 * MAX_GIF_FRAMES
+    workers = min(jobs, (in_flight - largest) // decode)
+    if workers < 1:
+        raise ValueError(f"MEMORY_BUDGET of {MEMORY_BUDGET} MB is too small: decoding the largest source image needs "
+                         f"{decode / 2**20:.0f} MB next to the sheets and only {(in_flight - largest) / 2**20:.0f} MB are left. "
+                         f"Raise it or lower SPRITESHEET_SIZE or ENCODE_WORKERS")
+    return workers, in_flight - workers * decode
+
+def encode_overhead():
+    # peak of one sheet encode on top of the sheet, measured on 4096px sheets: libwebp's buffers take about
+    # 2.5 sheets up to method 4 and 7.5 at method 6, the ssim search adds float luma of reference and candidate
+    sheet = SPRITESHEET_SIZE * SPRITESHEET_SIZE * 4
+    if SPRITESHEET_FORMAT != 'webp':
+        return sheet
+    methods = [WEBP_METHOD] if SHEET_ENCODING == 'fixed' else ENCODE_SEARCH_METHODS
+    factor = 8 if max(methods) >= 6 else 3
+    if SHEET_ENCODING == 'ssim':
+        factor += 3
+    return factor * sheet
+
+def memory_plan(image_count, decode=0):
+    # returns (encode workers, bytes of decodes and decoded sprites allowed in flight) that fit MEMORY_BUDGET;
+    # decode is what the largest source image takes to decode, one of them always has to fit
+    if MEMORY_BUDGET is None:
+        return ENCODE_WORKERS, None
+    budget = MEMORY_BUDGET * 1024 * 1024
+    sheet = SPRITESHEET_SIZE * SPRITESHEET_SIZE * 4
+    preview = image_count * PREVIEW_SIZE * PREVIEW_SIZE * 4 if PREVIEW_SIZE else 0
+    largest = SPRITE_SIZE * SPRITE_SIZE * 4 * MAX_GIF_FRAMES
+    encoding = encode_overhead()
+    # the sheet being filled and one being encoded (plus its premultiplied copy for the variants and the
+    # encoder's buffers), the preview atlas, the biggest gif and the decode of the largest source
+    required = 3 * sheet + encoding + preview + largest + decode
+    if required > budget:
+        raise ValueError(f"MEMORY_BUDGET of {MEMORY_BUDGET} MB is too small: one {SPRITESHEET_SIZE}px sheet being filled and one "
+                         f"being encoded ({encoding / 2**20:.0f} MB of encoder buffers), the preview atlas, a {MAX_GIF_FRAMES} "
+                         f"frame gif and decoding the largest source ({decode / 2**20:.0f} MB) need {required / 2**20:.0f} MB. "
+                         f"Raise it or lower SPRITESHEET_SIZE, PREVIEW_SIZE or MAX_GIF_FRAMES")
+    # every background encoder keeps one more finished sheet, its copy and its encoder's buffers alive
+    encode_workers = min(ENCODE_WORKERS, (budget - required) // (2 * sheet + encoding))
+    in_flight = budget - required - encode_workers * (2 * sheet + encoding) + largest + decode
+    return encode_workers, in_flight
+
+def build_spritesheets(all_image_paths, warm_cache=None, sheet_hashes=None, jobs=None, pack_order=None, report=None, pool=None):
+    if jobs is None:
+        jobs = JOBS
+    if sheet_hashes is None:
+        sheet_hashes = {}
+    if pack_order is None:
+        pack_order = all_image_paths
+    Path('spritesheets').mkdir(exist_ok=True)
+
+    layout_start = clock()
+    layout = load_layout() if STABLE_SLOTS else {}
+    old_slots = layout.get('slots', {})
+    reencode = bool(layout) and layout.get('encoding') != encoding_settings()
+    if not reencode:
+        for sheet_path, digest in layout.get('sheet_digests', {}).items():
+            sheet_hashes.setdefault(sheet_path, digest)
+
+    # sheets from the last build stay open for new sprites. All their slots are kept for this build;
+    # slots no image uses any more are dropped from the layout at the end, so the next build reuses the space.
+    # Their packers come from the state saved with the layout, or are rebuilt from the slots (slow, every
+    # slot is placed again) only when a new sprite is tried on the sheet
+    old_sheets = {}
+    for slot in old_slots.values():
+        sheet = old_sheets.setdefault(slot['ss'], {'ss': slot['ss'], 'packer': None, 'slots': [], 'image': None, 'new': []})
+        sheet['slots'].append(slot)
+    old_sheets = dict(natsorted(old_sheets.items()))
+    saved_packers = layout.get('packers', {})
+    finished_packers = {}
+
+    def sheet_packer(sheet):
+        if sheet['packer'] is None:
+            sheet['packer'] = new_packer()
+            if sheet['ss'] in saved_packers:
+                sheet['packer'].load_state(saved_packers[sheet['ss']])
+            else:
+                for slot in sheet['slots']:
+                    for x, y in slot_positions(slot):
+                        sheet['packer'].place(x - SPRITE_PADDING, y - SPRITE_PADDING, *packed_size(slot['w'], slot['h']))
+        return sheet['packer']
+    next_sheet_idx = layout.get('next_sheet', 0)
+    current = None
+    new_sheets = []
+
+    # one PREVIEW_SIZE cell per unique sprite; freed cells are refilled before the atlas grows
+    preview = layout.get('preview')
+    preview_cols = layout.get('preview_cols') or math.isqrt(max(len(pack_order) - 1, 0)) + 1
+    preview_cells = layout.get('preview_cells', 0)
+    used_cells = {slot['pv'][1] // PREVIEW_SIZE * preview_cols + slot['pv'][0] // PREVIEW_SIZE for slot in old_slots.values() if 'pv' in slot}
+    free_cells = sorted(set(range(preview_cells)) - used_cells, reverse=True)
+    preview_dirty = reencode
+    if PREVIEW_SIZE and preview is None:
+        preview_rows = -(-len(pack_order) // preview_cols)
+        preview = Image.new('RGBA', (preview_cols * PREVIEW_SIZE, preview_rows * PREVIEW_SIZE), (0, 0, 0, 0))
+
+    def add_preview(img):
+        nonlocal preview, preview_cells, preview_dirty
+        if free_cells:
+            cell = free_cells.pop()
+        else:
+            cell = preview_cells
+            preview_cells += 1
+        x = cell % preview_cols * PREVIEW_SIZE
+        y = cell // preview_cols * PREVIEW_SIZE
+        if y + PREVIEW_SIZE > preview.height:
+            grown = Image.new('RGBA', (preview.width, y + PREVIEW_SIZE), (0, 0, 0, 0))
+            grown.paste(preview, (0, 0))
+            preview = grown
+        size = (max(1, int(img.width * PREVIEW_SIZE / SPRITE_SIZE + 0.5)), max(1, int(img.height * PREVIEW_SIZE / SPRITE_SIZE + 0.5)))
+        preview.paste(Image.new('RGBA', (PREVIEW_SIZE, PREVIEW_SIZE), (0, 0, 0, 0)), (x, y))
+        preview.paste(img.resize(size, RESIZE_METHOD), (x, y))
+        preview_dirty = True
+        return [x, y]
+
+    pending = []
+    encode_stats = []
+
+    def encode(img, sheet_path, variants=True):
+        if encoder is None:
+            encode_stats.append(save_sheet(img, sheet_path, sheet_hashes, variants))
+            return
+        pending.append(encoder.submit(save_sheet, img, sheet_path, sheet_hashes, variants))
+        while len(pending) > encode_workers:
+            encode_stats.append(pending.pop(0).result())
+
+    def next_sheet():
+        # new sheets are filled one at a time and encoded as soon as the next one starts
+        nonlocal current, next_sheet_idx
+        if current is not None:
+            finished_packers[current['ss']] = current['packer']
+            encode(current['image'], current['ss'])
+        current = {
+            'ss': f'spritesheets/sprites_{next_sheet_idx}.{SPRITESHEET_FORMAT}',
+            'packer': new_packer(),
+            'image': Image.new('RGBA', (SPRITESHEET_SIZE, SPRITESHEET_SIZE), (0, 0, 0, 0))
         }
+        new_sheets.append(current['ss'])
+        next_sheet_idx += 1
+
+    def try_sheet(sheet, sizes):
+        # every rect of one sprite (all unique gif frames) has to land on the same sheet
+        trial = sheet_packer(sheet).copy() if len(sizes) > 1 else sheet_packer(sheet)
+        positions = [trial.insert(*packed_size(w, h)) for w, h in sizes]
+        if None in positions:
+            return None
+        sheet['packer'] = trial
+        return [(x + SPRITE_PADDING, y + SPRITE_PADDING) for x, y in positions]
+
+    def place(sizes, target=None):
+        # free space on the old sheets first, then the sheet being filled, then a new one
+        candidates = [target] if target is not None else []
+        candidates += list(old_sheets.values()) + ([current] if current is not None else [])
+        for sheet in candidates:
+            positions = try_sheet(sheet, sizes)
+            if positions is not None:
+                return sheet, positions
+        if current is not None and current['packer'].is_empty():
+            raise ValueError(f"{len(sizes)} sprites of {sizes[0]} don't fit on one {SPRITESHEET_SIZE}px sheet")
+        next_sheet()
+        return place(sizes)
+
+    # unchanged files keep their slot without being decoded
+    old_images = layout.get('images', {})
+    image_stats = {}
+    image_keys = {}
+    to_process = []
+    for img_path in pack_order:
+        st = os.stat(img_path)
+        image_stats[img_path] = [st.st_mtime_ns, st.st_size]
+        entry = old_images.get(img_path)
+        if entry and entry[:2] == image_stats[img_path] and entry[2] in old_slots:
+            image_keys[img_path] = entry[2]
+        else:
+            to_process.append(img_path)
+    kept_images = len(image_keys)
+
+    # the atlas only grows down, so once it would get much taller than wide its cells are laid out again
+    # on a square grid: cell numbers stay, positions change and the master is repainted from the old one
+    needed_cells = preview_cells - len(free_cells) + len(to_process)
+    if preview is not None and -(-needed_cells // preview_cols) > 2 * preview_cols:
+        cols = math.isqrt(max(needed_cells - 1, 0)) + 1
+        regridded = Image.new('RGBA', (cols * PREVIEW_SIZE, -(-max(needed_cells, preview_cells) // cols) * PREVIEW_SIZE), (0, 0, 0, 0))
+        for slot in old_slots.values():
+            if 'pv' in slot:
+                x, y = slot['pv']
+                cell = y // PREVIEW_SIZE * preview_cols + x // PREVIEW_SIZE
+                slot['pv'] = [cell % cols * PREVIEW_SIZE, cell // cols * PREVIEW_SIZE]
+                regridded.paste(preview.crop((x, y, x + PREVIEW_SIZE, y + PREVIEW_SIZE)), tuple(slot['pv']))
+        print(f"Preview atlas laid out again: {preview_cols} -> {cols} columns")
+        preview, preview_cols, preview_dirty = regridded, cols, True
+
+    # the budget is planned once the images to decode are known: the largest of them decides how
+    # many decode workers fit next to the sheets
+    decode = largest_decode(to_process) if MEMORY_BUDGET is not None else 0
+    encode_workers, in_flight = memory_plan(len(pack_order), decode)
+    decode_jobs, queue = decode_workers(jobs, in_flight, decode)
+    if in_flight is not None:
+        print(f"Memory budget: {MEMORY_BUDGET} MB, {encode_workers} encode workers, {decode_jobs} decode workers "
+              f"(largest source decodes to {decode / 2**20:.0f} MB), {queue / 2**20:.0f} MB of decoded sprites in flight")
+    # full sheets are encoded in the background while the next one is packed; at most encode_workers
+    # finished sheets wait for the encoder, so memory stays bounded
+    encoder = ThreadPoolExecutor(encode_workers) if encode_workers else None
+
+    cache_hits = 0
+    new_slots = {}
+    timings = {}
+    pasted = 0
+    # loading the layout and preview master, and the stat of every image to find the unchanged ones
+    lap(timings, 'layout', layout_start)
+    record_stage(report, 'layout', *timings['layout'], len(pack_order))
+    # a kept pool can't be shrunk, so a capped pass starts its own
+    frame_results = iter_frames(to_process, warm_cache, decode_jobs, report, queue, pool if decode_jobs == jobs else None)
+    for group in image_groups(pack_order):
+        items = []
+        claimed = set()
+        for img_path in group:
+            if img_path in image_keys:
+                continue
+            frames, hit = next(frame_results)
+            cache_hits += hit
+            is_gif = img_path.lower().endswith('.gif')
+            key = slot_key(img_path, frames, is_gif)
+            image_keys[img_path] = key
+            if key in old_slots or key in new_slots or key in claimed:
+                continue
+            claimed.add(key)
+            items.append((key, is_gif) + unique_sprite_frames(frames, is_gif))
+
+        target = None
+        mark = clock()
+        if len(items) > 1:
+            # keep the folder together: an old sheet with room for all of it, else the current
+            # sheet, else a fresh one rather than splitting it across two
+            sizes = [frame.size for item in items for frame in item[2]]
+            candidates = list(old_sheets.values()) + ([current] if current is not None else [])
+            target = next((sheet for sheet in candidates if fits(sheet_packer(sheet), sizes)), None)
+            if target is None and fits(new_packer(), sizes):
+                next_sheet()
+                target = current
+        lap(timings, 'pack', mark)
+
+        for key, is_gif, unique_frames, frame_order in items:
+            mark = clock()
+            sheet, positions = place([frame.size for frame in unique_frames], target)
+            mark = lap(timings, 'pack', mark)
+            for frame, pos in zip(unique_frames, positions):
+                if sheet['image'] is not None:
+                    sheet['image'].paste(frame, pos)
+                else:
+                    sheet['new'].append((frame, pos))
+                pasted += frame.width * frame.height * 4
+            lap(timings, 'paste', mark)
+            if is_gif:
+                slot = {'ss': sheet['ss'], 'fr': [list(positions[i]) for i in frame_order], 'anim': True}
+            else:
+                slot = {'ss': sheet['ss'], 'x': positions[0][0], 'y': positions[0][1]}
+            slot['w'] = unique_frames[0].width
+            slot['h'] = unique_frames[0].height
+            if preview is not None:
+                slot['pv'] = add_preview(unique_frames[0])
+            new_slots[key] = slot
+
+    # every result has been consumed, but the generator still sits inside its pool's with block;
+    # close it so that pool shuts down before the repaint starts another one
+    frame_results.close()
+    if current is not None:
+        finished_packers[current['ss']] = current['packer']
+        encode(current['image'], current['ss'])
+
+    slots = {}
+    for key in image_keys.values():
+        slots[key] = new_slots.get(key) or old_slots[key]
+    live_sheets = {slot['ss'] for slot in slots.values()}
+
+    # old sheets are only repainted when they received sprites (or their files are gone),
+    # from the sprites that still live on them
+    dirty = [sheet for ss, sheet in old_sheets.items() if ss in live_sheets and
+             (sheet['new'] or reencode or not all(Path(path).exists() for path in sheet_files(ss)))]
+    representative = {}
+    for img_path, key in image_keys.items():
+        representative.setdefault(key, img_path)
+    by_sheet = {}
+    for key, slot in slots.items():
+        by_sheet.setdefault(slot['ss'], []).append(key)
+    repaint_keys = [key for sheet in dirty for key in by_sheet[sheet['ss']] if key not in new_slots]
+    repaint_paths = [representative[key] for key in repaint_keys]
+    decode_jobs, queue = decode_workers(jobs, in_flight, largest_decode(repaint_paths) if in_flight is not None else 0)
+    repaint_frames = iter_frames(repaint_paths, warm_cache, decode_jobs, report, queue, pool if decode_jobs == jobs else None)
+    for sheet in dirty:
+        image = Image.new('RGBA', (SPRITESHEET_SIZE, SPRITESHEET_SIZE), (0, 0, 0, 0))
+        for key in by_sheet[sheet['ss']]:
+            if key in new_slots:
+                continue
+            frames, hit = next(repaint_frames)
+            mark = clock()
+            unique_frames = unique_sprite_frames(frames, slots[key].get('anim', False))[0]
+            for frame, pos in zip(unique_frames, slot_positions(slots[key])):
+                image.paste(frame, pos)
+                pasted += frame.width * frame.height * 4
+            lap(timings, 'paste', mark)
+        mark = clock()
+        for frame, pos in sheet['new']:
+            image.paste(frame, pos)
+            pasted += frame.width * frame.height * 4
+        lap(timings, 'paste', mark)
+        encode(image, sheet['ss'])
+
+    sheet_paths = set()
+    for ss in live_sheets:
+        sheet_paths.update(sheet_files(ss))
+    if preview is not None and slots:
+        preview_rows = -(-preview_cells // preview_cols)
+        if preview_dirty or not Path(preview_path()).exists():
+            encode(preview.crop((0, 0, preview.width, preview_rows * PREVIEW_SIZE)), preview_path(), variants=False)
+        sheet_paths.add(preview_path())
+    for future in pending:
+        encode_stats.append(future.result())
+    if encoder is not None:
+        encoder.shutdown()
+
+    for file in Path('spritesheets').glob('*'):
+        if str(file) not in sheet_paths:
+            file.unlink()
+            sheet_hashes.pop(str(file), None)
+
+    if STABLE_SLOTS:
+        # a sheet that lost slots gets its packer rebuilt from the remaining ones when next needed
+        shrunk = {slot['ss'] for key, slot in old_slots.items() if key not in slots}
+        packer_states = {}
+        for ss in live_sheets - shrunk:
+            if ss in finished_packers:
+                packer_states[ss] = finished_packers[ss].state()
+            elif old_sheets[ss]['packer'] is not None:
+                packer_states[ss] = old_sheets[ss]['packer'].state()
+            elif ss in saved_packers:
+                packer_states[ss] = saved_packers[ss]
+        save_layout({
+            'version': LAYOUT_VERSION,
+            'settings': layout_settings(),
+            'encoding': encoding_settings(),
+            'next_sheet': next_sheet_idx,
+            'preview_cols': preview_cols,
+            'preview_cells': preview_cells,
+            'images': {img_path: image_stats[img_path] + [key] for img_path, key in image_keys.items()},
+            'slots': slots,
+            'packers': packer_states,
+            'sheet_digests': {path: sheet_hashes[path] for path in sheet_paths if path in sheet_hashes}
+        }, preview if preview_dirty else None)
+
+    if 'pack' in timings:
+        record_stage(report, 'pack', *timings['pack'], len(new_slots))
+    if 'paste' in timings:
+        record_stage(report, 'paste', *timings['paste'], len(new_slots) + len(repaint_keys), pasted, 0)
+
+    if USE_SPRITE_CACHE:
+        print(f"Sprite cache: {cache_hits} hits, {len(to_process) - cache_hits} processed")
+    if layout:
+        print(f"Stable slots: {kept_images} unchanged images kept their slot, {len(new_slots)} new sprites placed, "
+              f"{len(dirty)} old sheets repainted, {len(new_sheets)} new sheets")
+
+    sprite_data = {}
+    users = {}
+    for idx, img_path in enumerate(all_image_paths):
+        key = image_keys[img_path]
+        sprite_data[img_path] = {**slots[key], 'gi': idx, 'path': img_path}
+        users[key] = users.get(key, 0) + 1
+
+    gif_frames = 0
+    gif_slots = 0
+    dup_slots = 0
+    dup_bytes = 0
+    used_area = 0
+    for key, slot in slots.items():
+        positions = len(slot_positions(slot))
+        if slot.get('anim'):
+            gif_frames += len(slot['fr'])
+            gif_slots += positions
+        dup_slots += (users[key] - 1) * positions
+        dup_bytes += (users[key] - 1) * positions * slot['w'] * slot['h'] * 4
+        used_area += positions * slot['w'] * slot['h']
+    if gif_frames:
+        print(f"GIF frames: {gif_frames} frames in {gif_slots} slots ({gif_frames - gif_slots} duplicates shared)")
+    if len(image_keys) > len(slots):
+        print(f"Duplicates: {len(image_keys) - len(slots)} images share an existing sprite, saved {dup_slots} slots ({dup_bytes / 1024:.0f} KB of RGBA)")
+    unchanged = 0
+    for sheet_path, seconds, cpu, size, variant_bytes, pixels, options, ssim in encode_stats:
+        if seconds is None:
+            unchanged += 1
+            continue
+        record_stage(report, 'encode', seconds, cpu, 1, pixels * 4, size + variant_bytes)
+        if report is not None:
+            report['sheets'].append({'path': sheet_path, 'seconds': round(seconds, 4), 'bytes': size,
+                                     'variant_bytes': variant_bytes, 'options': options,
+                                     'ssim': round(float(ssim), 4) if ssim is not None else None})
+        settings = ', '.join(f'{key} {value}' for key, value in options.items())
+        if ssim is not None:
+            settings += f', ssim {ssim:.4f}'
+        if variant_bytes:
+            settings += f', variants {variant_bytes / 1024:.0f} KB'
+        print(f"Encoded {sheet_path} in {seconds:.2f}s: {pixels / seconds / 1e6:.1f} Mpx/s, {size / 1024:.0f} KB ({settings})")
+    if unchanged:
+        print(f"{unchanged} sheets unchanged, not re-encoded")
+    if live_sheets:
+        fill = used_area / (len(live_sheets) * SPRITESHEET_SIZE * SPRITESHEET_SIZE)
+        print(f"Packed {len(live_sheets)} sheets with {PACKING}, {fill:.0%} of sheet area used")
+
+    return sprite_data
+
+def write_if_changed(path, content):
+    path = Path(path)
+    if isinstance(content, bytes):
+        if path.exists() and path.read_bytes() == content:
+            return False
+        path.write_bytes(content)
+        return True
+    if path.exists() and path.read_text() == content:
+        return False
+    path.write_text(content)
+    return True
+
+def write_json(path, data):
+    # stream minified chunks to a temp file so the whole document never sits in memory as one string,
+    # then only replace the target when the content actually changed
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    with open(tmp_path, 'w') as f:
+        for chunk in encoder.iterencode(data):
+            f.write(chunk)
+    if path.exists() and filecmp.cmp(tmp_path, path, shallow=False):
+        tmp_path.unlink()
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+def precompress(paths):
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    raw_total = gz_total = br_total = 0
+    for path in paths:
+        path = Path(path)
+        raw = path.read_bytes()
+        raw_total += len(raw)
+        targets = [(path.with_name(path.name + '.gz'), lambda b: gzip.compress(b, GZIP_LEVEL, mtime=0))]
+        if brotli:
+            targets.append((path.with_name(path.name + '.br'), lambda b: brotli.compress(b, quality=BROTLI_QUALITY)))
+        for target, compress in targets:
+            # skip files whose compressed sibling is already newer than the source
+            if not target.exists() or target.stat().st_mtime_ns < path.stat().st_mtime_ns:
+                target.write_bytes(compress(raw))
+        gz_total += path.with_name(path.name + '.gz').stat().st_size
+        if brotli:
+            br_total += path.with_name(path.name + '.br').stat().st_size
+
+    if raw_total:
+        summary = f"Precompressed {len(paths)} files: {raw_total / 1024:.1f} KB -> gz {gz_total / 1024:.1f} KB ({100 - 100 * gz_total / raw_total:.0f}% smaller)"
+        if brotli:
+            summary += f", br {br_total / 1024:.1f} KB ({100 - 100 * br_total / raw_total:.0f}% smaller)"
+        else:
+            summary += " (install brotli for .br files)"
+        print(summary)
+
+def add_shard(shards, start, end):
+    if start == end:
+        return
+    # neighbouring small subtrees share a shard as long as it stays under SHARD_SIZE
+    if shards and shards[-1][1] == start and end - shards[-1][0] <= SHARD_SIZE:
+        shards[-1][1] = end
     else:
-        img = Image.open(img_path).convert('RGBA')
-        img = resize_image(img)
-        img = apply_filter(img)       
+        shards.append([start, end])
+
+def plan_shards(node, shards):
+    start, end = node['ai']
+    if end - start <= SHARD_SIZE:
+        add_shard(shards, start, end)
+        return shards
+    own_start, own_end = node['oi']
+    for chunk_start in range(own_start, own_end, SHARD_SIZE):
+        add_shard(shards, chunk_start, min(chunk_start + SHARD_SIZE, own_end))
+    for child in node['children']:
+        plan_shards(child, shards)
+    return shards
+
+def sprite_stubs(sprites):
+    # sheet index, w, h and preview cell of every sprite as one flat column in data.json: enough to draw
+    # any node from the preview atlas (the root covers the whole table) before its shards arrive
+    sheets = list(dict.fromkeys(sprite['ss'] for sprite in sprites))
+    sheet_idx = {ss: idx for idx, ss in enumerate(sheets)}
+    stubs = []
+    for sprite in sprites:
+        stubs += [sheet_idx[sprite['ss']], sprite['w'], sprite['h'], *sprite['pv']]
+    return sheets, stubs
+
+def write_shards(root, sprites):
+    # each shard holds the sprite records of whole subtrees, so opening a node only fetches its own shards
+    Path(SHARD_DIR).mkdir(exist_ok=True)
+    shards = []
+    for shard_idx, (start, end) in enumerate(plan_shards(root, [])):
+        shard_path = f'{SHARD_DIR}/sprites_{shard_idx}.json'
+        write_json(shard_path, sprites[start:end])
+        shards.append([start, end, shard_path])
+
+    shard_paths = {shard[2] for shard in shards}
+    keep = shard_paths | {shard_path + ext for shard_path in shard_paths for ext in ['.gz', '.br']}
+    for file in Path(SHARD_DIR).glob('*'):
+        if str(file) not in keep:
+            file.unlink()
+    return shards
+
+def pack_binary_data(root, sprites, text_paths, sprite_config):
+    # layout: 8 x u32 header, then 4-byte aligned little-endian sections:
+    # string offsets + utf-8 bytes, sprite columns, text table, node rows, 'at' ranges, gif frame positions
+    strings = []
+    string_idx = {}
+    def intern(value):
+        if value not in string_idx:
+            string_idx[value] = len(strings)
+            strings.append(value)
+        return string_idx[value]
+
+    # breadth-first so every node's children are consecutive rows
+    nodes = [root]
+    for node in nodes:
+        nodes.extend(node['children'])
+    first_child = {}
+    next_row = 1
+    for node in nodes:
+        first_child[id(node)] = next_row
+        next_row += len(node['children'])
+
+    node_rows = array('I')
+    at_ranges = array('I')
+    for node in nodes:
+        flags = (1 if node['na'] else 0) | (2 if node['sa'] else 0)
+        grid_layout = intern(node['grid_layout']) if 'grid_layout' in node else NO_STRING
+        node_rows.extend([
+            intern(node['name']), intern(node['path']), intern(node['type']), grid_layout, flags,
+            first_child[id(node)], len(node['children']),
+            *node['ai'], *node['oi'], *node['ot'],
+            len(at_ranges) // 2, len(node['at'])
+        ])
+        for start, end in node['at']:
+            at_ranges.extend([start, end])
+
+    # animated sprites point at a run of (x, y) pairs in the frame pool, static ones use x/y directly
+    frame_pool = array('H')
+    sprite_frames = array('I')
+    sprite_fc = array('H')
+    for sprite in sprites:
+        if sprite.get('anim'):
+            sprite_frames.append(len(frame_pool) // 2)
+            sprite_fc.append(len(sprite['fr']))
+            for x, y in sprite['fr']:
+                frame_pool.extend([x, y])
+        else:
+            sprite_frames.append(0)
+            sprite_fc.append(0)
+    sprite_ss = array('I', [intern(sprite['ss']) for sprite in sprites])
+    sprite_gi = array('I', [sprite['gi'] for sprite in sprites])
+    sprite_path = array('I', [intern(sprite['path']) for sprite in sprites])
+    sprite_x = array('H', [sprite.get('x', 0) for sprite in sprites])
+    sprite_y = array('H', [sprite.get('y', 0) for sprite in sprites])
+    sprite_w = array('H', [sprite['w'] for sprite in sprites])
+    sprite_h = array('H', [sprite['h'] for sprite in sprites])
+    sprite_pv_x = array('H', [sprite['pv'][0] if 'pv' in sprite else NO_PREVIEW for sprite in sprites])
+    sprite_pv_y = array('H', [sprite['pv'][1] if 'pv' in sprite else NO_PREVIEW for sprite in sprites])
+    text_table = array('I', [intern(text_path) for text_path in text_paths])
+    config_idx = intern(json.dumps(sprite_config))
+
+    encoded = [value.encode('utf-8') for value in strings]
+    string_offsets = array('I', [0])
+    for value in encoded:
+        string_offsets.append(string_offsets[-1] + len(value))
+
+    header = array('I', [BINARY_MAGIC, len(nodes), len(sprites), len(strings), len(text_paths), len(at_ranges) // 2, config_idx, len(frame_pool) // 2])
+    sections = [header, string_offsets, b''.join(encoded),
+                sprite_ss, sprite_frames, sprite_gi, sprite_path, sprite_x, sprite_y, sprite_w, sprite_h, sprite_fc, sprite_pv_x, sprite_pv_y,
+                text_table, node_rows, at_ranges, frame_pool]
+
+    out = bytearray()
+    for section in sections:
+        if isinstance(section, array):
+            if sys.byteorder == 'big':
+                section.byteswap()
+            section = section.tobytes()
+        out += section
+        out += bytes(-len(out) % 4)
+    return bytes(out)
+
+def sheet_report(root, sprites):
+    # a node's first render fetches every sheet its image range touches
+    sheet_bytes = {}
+    rows = []
+
+    def visit(node):
+        start, end = node['ai']
+        if end > start:
+            sheets = {sprite['ss'] for sprite in sprites[start:end]}
+            for sheet in sheets:
+                if sheet not in sheet_bytes:
+                    sheet_bytes[sheet] = os.path.getsize(sheet)
+            rows.append((len(sheets), sum(sheet_bytes[sheet] for sheet in sheets), end - start, node['path']))
+        for child in node['children']:
+            visit(child)
+
+    visit(root)
+    if not rows:
+        return
+    mean_sheets = sum(row[0] for row in rows) / len(rows)
+    mean_bytes = sum(row[1] for row in rows) / len(rows)
+    print(f"Sheets per node: mean {mean_sheets:.2f}, max {max(rows)[0]}, first render fetches {mean_bytes / 1024:.0f} KB on average")
+    for sheet_count, size, image_count, path in sorted(rows, reverse=True)[:SHEET_REPORT_LIMIT]:
+        if sheet_count > 1:
+            print(f"  {sheet_count:>3} sheets {size / 1024:>8.0f} KB  {path} ({image_count} images)")
+
+def read_header(img_path):
+    # open() only parses the header; n_frames walks the gif frame headers without decoding them
+    with Image.open(img_path) as img:
+        frames = min(img.n_frames, MAX_GIF_FRAMES) if img_path.lower().endswith('.gif') else 1
+        return sprite_dimensions(*img.size), frames
+
+def plan():
+    # dry run of a fresh build: sprite sizes from the image headers go through the same grouping and
+    # packing as build_spritesheets, nothing is decoded or encoded. Without pixels there is no dedupe,
+    # so sheets and slots are an upper bound
+    start = time.perf_counter()
+    root, image_paths, text_paths = scan_folder(Path('.'), SCAN_IGNORE)
+    pack_order = image_paths if SHEET_ASSIGNMENT == 'subtree' else natsorted(image_paths)
+    with ThreadPoolExecutor(SCAN_WORKERS) as executor:
+        headers = dict(zip(pack_order, executor.map(read_header, pack_order)))
+
+    sheets = []
+
+    def next_sheet():
+        sheets.append({'idx': len(sheets), 'packer': new_packer(), 'sprites': 0, 'frames': 0, 'area': 0})
+        return sheets[-1]
+
+    def try_sheet(sheet, sizes):
+        trial = sheet['packer'].copy()
+        if not all(trial.insert(*packed_size(w, h)) for w, h in sizes):
+            return False
+        sheet['packer'] = trial
+        return True
+
+    sheet_of = {}
+    for group in image_groups(pack_order):
+        target = None
+        if len(group) > 1:
+            sizes = [headers[img_path][0] for img_path in group for _ in range(headers[img_path][1])]
+            if sheets and fits(sheets[-1]['packer'], sizes):
+                target = sheets[-1]
+            elif fits(new_packer(), sizes):
+                target = next_sheet()
+        for img_path in group:
+            size, frame_count = headers[img_path]
+            sizes = [size] * frame_count
+            candidates = ([target] if target is not None else []) + sheets[-1:]
+            sheet = next((sheet for sheet in candidates if try_sheet(sheet, sizes)), None)
+            if sheet is None:
+                if sheets and sheets[-1]['packer'].is_empty():
+                    raise ValueError(f"{frame_count} sprites of {size} don't fit on one {SPRITESHEET_SIZE}px sheet")
+                sheet = next_sheet()
+                if not try_sheet(sheet, sizes):
+                    raise ValueError(f"{frame_count} sprites of {size} don't fit on one {SPRITESHEET_SIZE}px sheet")
+            sheet['sprites'] += 1
+            sheet['frames'] += frame_count
+            sheet['area'] += frame_count * size[0] * size[1]
+            sheet_of[img_path] = sheet['idx']
+
+    sheet_pixels = SPRITESHEET_SIZE * SPRITESHEET_SIZE
+    print(f"Plan for {len(pack_order)} images, {SPRITESHEET_SIZE}px sheets, {SPRITE_SIZE}px sprites, {PACKING}/{SHEET_ASSIGNMENT}:")
+    for sheet in sheets:
+        print(f"  sprites_{sheet['idx']}.{SPRITESHEET_FORMAT}: {sheet['sprites']:>6} images {sheet['frames']:>6} slots  "
+              f"{sheet['area'] / sheet_pixels:>4.0%} used")
+
+    rows = []
+
+    def visit(node):
+        start, end = node['ai']
+        if end > start:
+            rows.append((len({sheet_of[img_path] for img_path in image_paths[start:end]}), end - start, node['path']))
+        for child in node['children']:
+            visit(child)
+
+    visit(root)
+    if rows:
+        print(f"Sheets per node: mean {sum(row[0] for row in rows) / len(rows):.2f}, max {max(rows)[0]}")
+        for sheet_count, image_count, path in sorted(rows, reverse=True)[:SHEET_REPORT_LIMIT]:
+            if sheet_count > 1:
+                print(f"  {sheet_count:>3} sheets  {path} ({image_count} images)")
+
+    slots = sum(sheet['frames'] for sheet in sheets)
+    gif_frames = sum(headers[img_path][1] for img_path in pack_order if img_path.lower().endswith('.gif'))
+    raw = len(sheets) * sheet_pixels * 4 * (1 + sum((size / SPRITE_SIZE) ** 2 for size in sheet_variants()))
+    if PREVIEW_SIZE:
+        raw += len(pack_order) * PREVIEW_SIZE * PREVIEW_SIZE * 4
+    print(f"{len(sheets)} sheets, {slots} slots ({gif_frames} gif frames), {raw / 2**20:.0f} MB of RGBA to encode "
+          f"(upper bounds, duplicates are only found when decoding)")
+    # the encoded size can only be guessed from the compression the last real build got
+    if BUILD_REPORT and Path(BUILD_REPORT).exists():
+        encoded = json.loads(Path(BUILD_REPORT).read_text())['stages'].get('encode')
+        if encoded and encoded['bytes_in']:
+            ratio = encoded['bytes_out'] / encoded['bytes_in']
+            print(f"About {raw * ratio / 2**20:.0f} MB of {SPRITESHEET_FORMAT} at the last build's compression ({ratio:.1%})")
+    print(f"Planned in {time.perf_counter() - start:.2f}s")
+    return sheets
+
+def build(warm_cache=None, sheet_hashes=None, jobs=None, pool=None):
+    if jobs is None:
+        jobs = JOBS
+    report = {'stages': {}, 'images': [], 'sheets': [], 'rss': {}, 'peak_rss': {}} if BUILD_REPORT else None
+    start = clock()
+    start_cpu = process_cpu()
+    root, image_paths, text_paths = scan_folder(Path('.'), SCAN_IGNORE)
+    mark = clock()
+    # folders are listed on SCAN_WORKERS threads, so the scan's cpu is the whole process's
+    record_stage(report, 'scan', mark[0] - start[0], process_cpu() - start_cpu, len(image_paths) + len(text_paths))
+    record_peak(report, 'scan')
+
+    # gi follows natsort order, the sprite table follows the tree's DFS order; in 'subtree' mode sheets
+    # are packed in DFS order too, so a node's images (one contiguous range) land on few sheets
+    pack_order = image_paths if SHEET_ASSIGNMENT == 'subtree' else None
+    sprite_data = build_spritesheets(natsorted(image_paths), warm_cache, sheet_hashes, jobs, pack_order, report, pool)
+    sprites = [sprite_data[p] for p in image_paths]
+    sheet_report(root, sprites)
+    record_peak(report, 'sprites')
+    mark = clock()
+
+    sprite_config = {
+        'spritesheet_size': SPRITESHEET_SIZE,
+        'sprite_size': SPRITE_SIZE,
+        'sprite_padding': SPRITE_PADDING,
+        'sprites_per_row': SPRITES_PER_ROW,
+        'sheet_variants': sheet_variants(),
+        'preview': {'path': preview_path(), 'size': PREVIEW_SIZE} if PREVIEW_SIZE else None,
+        'stack_spacing': STACK_SPACING,
+        'seed': SEED,
+        'loadingscreen_img_increment': LOADINGSCREEN_IMG_INCREMENT,
+        'ordered_grid_layout': ORDERED_GRID_LAYOUT,
+        'rotation_speed': ROTATION_SPEED,
+        'random_textdiv_position': RANDOM_TEXTDIV_POSITION,
+        'quickload_threshold': QUICKLOAD_THRESHOLD 
+    }
 
- 
-        col = slot_idx % SPRITES_PER_ROW
-        row = slot_idx // SPRITES_PER_ROW
-        x = col * SPRITE_SIZE + SPRITE_PADDING
-        y = row * SPRITE_SIZE + SPRITE_PADDING
-        sheet.paste(img, (x, y))
-        
-        sprite_data[img_path] = {
-            'ss': f'spritesheets/sprites_{sheet_idx}.{SPRITESHEET_FORMAT}',
-            'idx': slot_idx,
-            'gi': idx,
-            'w': img.width,
-            'h': img.height,
-            'path': img_path
+    outputs = ['index.html'] + text_paths
+    if DATA_FORMAT == 'binary':
+        write_if_changed('data.bin', pack_binary_data(root, sprites, text_paths, sprite_config))
+        data_paths = ['data.bin']
+    else:
+        data = {'tree': root, 'texts': text_paths, 'sprite_config': sprite_config}
+        data_paths = []
+        if SHARD_DATA:
+            data['sprite_count'] = len(sprites)
+            data['shards'] = write_shards(root, sprites)
+            data_paths += [shard[2] for shard in data['shards']]
+            if PREVIEW_SIZE:
+                data['stub_sheets'], data['stubs'] = sprite_stubs(sprites)
+        else:
+            data['sprites'] = sprites
+        write_json('data.json', data)
+        data_paths.append('data.json')
+    outputs += data_paths
+    mark = record_output(report, 'data', mark, len(sprites), data_paths)
+    write_if_changed('index.html', render_index_html())
+    mark = record_output(report, 'html', mark, 1, ['index.html'])
+
+    if PRECOMPRESS:
+        outputs = list(dict.fromkeys(outputs))
+        precompress(outputs)
+        compressed = [path + ext for path in outputs for ext in ['.gz', '.br'] if os.path.exists(path + ext)]
+        record_output(report, 'precompress', mark, len(outputs), compressed, sum(os.path.getsize(path) for path in outputs))
+
+    if report is not None:
+        end = clock()
+        write_build_report(report, end[0] - start[0], process_cpu() - start_cpu)
+
+    return root, sprites, text_paths
+
+def process_cpu():
+    # this process (all threads) plus finished worker processes; a pool kept alive by a Builder isn't counted
+    cpu = time.process_time()
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += usage.ru_utime + usage.ru_stime
+    return cpu
+
+def record_output(report, stage, mark, items, paths, bytes_in=0):
+    # note: cpu here is the main thread's, which is the only one writing outputs
+    now = clock()
+    if report is not None:
+        bytes_out = sum(os.path.getsize(path) for path in paths)
+        record_stage(report, stage, now[0] - mark[0], now[1] - mark[1], items, bytes_in, bytes_out)
+        record_peak(report, stage)
+    return now
+
+def current_rss():
+    # resident bytes of this process right now (Linux only). The kernel's high-water mark isn't reset
+    # for stages: that would also reset what wait4/ru_maxrss report to whoever started the build
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def peak_rss():
+    # high-water mark in bytes of the calling process since it started
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def record_peak(report, stage):
+    # what the stage left resident, and the process peak so far (a later stage raising it shows up here)
+    if report is not None:
+        report['rss'][stage] = current_rss()
+        report['peak_rss']['process'] = peak_rss()
+
+def write_build_report(report, wall, cpu):
+    # fixed key order and rounding so two reports diff line by line; stage wall times of parallel
+    # stages (decode, resize, encode...) are summed over workers and can exceed the build's wall time
+    stages = {}
+    for stage, entry in report['stages'].items():
+        stages[stage] = {
+            'wall': round(entry['wall'], 4),
+            'cpu': round(entry['cpu'], 4),
+            'items': entry['items'],
+            'items_per_sec': round(entry['items'] / entry['wall'], 1) if entry['wall'] else None,
+            'bytes_in': entry['bytes_in'],
+            'bytes_out': entry['bytes_out']
         }
-        slot_idx += 1
-    
-    if slot_idx >= SPRITES_PER_SHEET:
-        sheet.save(f'spritesheets/sprites_{sheet_idx}.{SPRITESHEET_FORMAT}')
-        sheet_idx += 1
-        slot_idx = 0
-        sheet = Image.new('RGBA', (SPRITESHEET_SIZE, SPRITESHEET_SIZE), (0, 0, 0, 0))
-
-if slot_idx > 0:
-    sheet.save(f'spritesheets/sprites_{sheet_idx}.{SPRITESHEET_FORMAT}')
-
-def replace_images(node):
-    node['ai'] = [sprite_data[p] for p in node['ai']]
-    node['oi'] = [sprite_data[p] for p in node['oi']]
+    slowest = []
+    for seconds, img_path, hit, timings in sorted(report['images'], key=lambda image: (-image[0], image[1]))[:BUILD_REPORT_SLOWEST]:
+        slowest.append({
+            'path': img_path,
+            'seconds': round(seconds, 4),
+            'cached': hit,
+            'stages': {stage: round(wall, 4) for stage, (wall, cpu) in timings.items()}
+        })
+    data = {
+        'wall': round(wall, 4),
+        'cpu': round(cpu, 4),
+        'images': len(report['images']),
+        'stages': stages,
+        # 'rss' is this process's resident size at the end of each stage; 'peak_rss' holds high-water marks
+        # since the processes started: this one, and the largest of the workers that decoded this build
+        'rss': report['rss'],
+        'peak_rss': report['peak_rss'],
+        'slowest_images': slowest,
+        'sheets': sorted(report['sheets'], key=lambda sheet: sheet['path'])
+    }
+    Path(BUILD_REPORT).write_text(json.dumps(data, indent=1) + '\n')
+
+    busiest = sorted(stages.items(), key=lambda item: -item[1]['wall'])[:3]
+    summary = ', '.join(f"{stage} {entry['wall']:.2f}s" for stage, entry in busiest)
+    peak = report['peak_rss'].get('process') or 0
+    workers = report['peak_rss'].get('workers')
+    worker_peak = f", {workers / 2**20:.0f} MB per worker" if workers else ''
+    print(f"Build report: {wall:.2f}s wall, {cpu:.2f}s cpu ({summary}), peak RSS {peak / 2**20:.0f} MB{worker_peak} -> {BUILD_REPORT}")
+
+def folder_paths(node, paths):
+    paths.append(node['path'])
     for child in node['children']:
-        replace_images(child)
-
-replace_images(root)
-
-sprite_config = {
-    'spritesheet_size': SPRITESHEET_SIZE,
-    'sprite_size': SPRITE_SIZE,
-    'sprite_padding': SPRITE_PADDING,
-    'sprites_per_row': SPRITES_PER_ROW,
-    'stack_spacing': STACK_SPACING,
-    'seed': SEED,
-    'loadingscreen_img_increment': LOADINGSCREEN_IMG_INCREMENT,
-    'ordered_grid_layout': ORDERED_GRID_LAYOUT,
-    'rotation_speed': ROTATION_SPEED,
-    'random_textdiv_position': RANDOM_TEXTDIV_POSITION,
-    'quickload_threshold': QUICKLOAD_THRESHOLD 
-}
-
-with open('data.json', 'w') as f:
-    json.dump({'tree': root, 'sprite_config': sprite_config}, f, indent=2)
-
-with open('index.html', 'w') as f:
-    f.write(f'''<!DOCTYPE html>
+        folder_paths(child, paths)
+    return paths
+
+def source_signature(root, sprites, text_paths):
+    # folder mtimes catch added/removed/renamed entries, file mtimes catch images re-exported in place
+    file_paths = [sprite['path'] for sprite in sprites] + text_paths
+    for folder in folder_paths(root, []):
+        file_paths.append(folder)
+        file_paths += [os.path.join(folder, marker) for marker in MARKER_FILES]
+    signature = {}
+    for file_path in file_paths:
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        signature[file_path] = (st.st_mtime_ns, st.st_size)
+    return signature
+
+@contextmanager
+def configured(config):
+    # settings are module globals read all over the pipeline, so a config is applied to them for
+    # the duration of a build and the previous values are restored afterwards
+    unknown = [name for name in config if not name.isupper() or name not in globals()]
+    if unknown:
+        raise ValueError(f"unknown settings: {', '.join(unknown)}")
+    saved = {name: globals()[name] for name in list(config) + ['SPRITES_PER_ROW', 'SPRITES_PER_SHEET']}
+    globals().update(config)
+    if 'SPRITES_PER_ROW' not in config:
+        globals()['SPRITES_PER_ROW'] = SPRITESHEET_SIZE // SPRITE_SIZE
+    if 'SPRITES_PER_SHEET' not in config:
+        globals()['SPRITES_PER_SHEET'] = SPRITES_PER_ROW * SPRITES_PER_ROW
+    try:
+        yield
+    finally:
+        globals().update(saved)
+
+class Builder:
+    # library entry point: config is a dict of setting overrides ({'SPRITESHEET_SIZE': 2048, ...}).
+    # The warm sprite cache, sheet hashes and worker pool are kept between builds, so watch mode,
+    # a dev server or tests can rebuild in one process without restarting or re-decoding anything
+    def __init__(self, config=None, path='.', jobs=None, keep_pool=True, keep_warm=True):
+        self.config = dict(config or {})
+        self.path = path
+        self.jobs = jobs
+        self.keep_pool = keep_pool
+        self.warm_cache = WarmCache() if keep_warm else None
+        self.sheet_hashes = {}
+        self.pool = None
+        self.settings = None
+
+    @contextmanager
+    def active(self):
+        # the working directory is process wide, so only one Builder can build at a time
+        cwd = os.getcwd()
+        with configured(self.config):
+            os.chdir(self.path)
+            try:
+                yield
+            finally:
+                os.chdir(cwd)
+
+    def worker_pool(self, jobs):
+        # workers are initialized with the sprite settings, so a change restarts them and drops
+        # the warm sprites made with the old ones
+        settings = worker_settings()
+        if settings != self.settings:
+            self.close()
+            if self.warm_cache is not None:
+                self.warm_cache.clear()
+            self.settings = settings
+        if self.pool is None and jobs > 1 and self.keep_pool:
+            self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(settings,))
+        return self.pool
+
+    def build(self):
+        # returns (root, sprites, text_paths): the node tree and the DFS-ordered sprite and text tables
+        with self.active():
+            jobs = JOBS if self.jobs is None else self.jobs
+            return build(self.warm_cache, self.sheet_hashes, jobs, self.worker_pool(jobs))
+
+    def plan(self):
+        with self.active():
+            return plan()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def settling(paths, interval):
+    # a file modified within the last poll may still be written (an export in progress), so the
+    # rebuild waits for it; changed folders are checked for such files too, that's how new ones show up
+    cutoff = time.time_ns() - interval * 1e9
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                with os.scandir(path) as it:
+                    if any(entry.is_file() and entry.stat().st_mtime_ns > cutoff for entry in it):
+                        return True
+            elif os.stat(path).st_mtime_ns > cutoff:
+                return True
+        except FileNotFoundError:
+            continue
+    return False
+
+def try_build(builder):
+    # a broken or half-written source shouldn't end the watch; the next poll tries again
+    try:
+        return builder.build()
+    except Exception as e:
+        print(f"Build failed: {type(e).__name__}: {e}, retrying on the next poll")
+        return None
+
+def watch(builder, interval=None):
+    if interval is None:
+        with builder.active():
+            interval = WATCH_INTERVAL
+    result = try_build(builder)
+    while result is None:
+        time.sleep(interval)
+        result = try_build(builder)
+    print("Generated spritesheets, data.json and index.html")
+    with builder.active():
+        signature = source_signature(*result)
+    print(f"Watching for changes every {interval}s (ctrl-c to stop)")
+    while True:
+        time.sleep(interval)
+        with builder.active():
+            new_signature = source_signature(*result)
+        if new_signature == signature:
+            continue
+        changed = {p for p in new_signature.keys() | signature.keys() if new_signature.get(p) != signature.get(p)}
+        with builder.active():
+            if settling(changed, interval):
+                continue
+        start = time.time()
+        new_result = try_build(builder)
+        # keep the old signature after a failure, so the same change is built again on the next poll
+        if new_result is None:
+            continue
+        result = new_result
+        # the build itself can touch the root folder (data.json, manifest), so re-read after it
+        with builder.active():
+            signature = source_signature(*result)
+        print(f"Rebuilt after {len(changed)} change(s) in {time.time() - start:.2f}s")
+
+def render_index_html():
+    return f'''<!DOCTYPE html>
 <html>
 <head>
 <link rel="stylesheet" href="styles.css">
@@ -452,6 +2180,7 @@ let activeScenes = [];
 const spritesheets = {{}};
 const pendingLoads = {{}};
 const materialCache = {{}};
+const sheetShown = {{}};
 const geometryCache = {{}};
 
 function seededRandom(seed) {{
@@ -468,26 +2197,205 @@ function updateURL(node) {{
 
 
 
-fetch('data.json')
-    .then(r => r.json())
+// ai/oi/ot are [start, end) ranges into the sprite/text tables and at is a list of them;
+// they're swapped for getters that slice the tables the first time a node is looked at
+let spriteTable = [];
+let spriteShards = [];
+let spriteStubs = false;
+
+function rangeLoaded(start, end) {{
+    return spriteShards.every(shard => shard.loaded || shard.end <= start || shard.start >= end);
+}}
+
+async function loadShards(start, end) {{
+    await Promise.all(spriteShards
+        .filter(shard => !shard.loaded && shard.start < end && shard.end > start)
+        .map(shard => {{
+            if (!shard.pending) {{
+                shard.pending = fetch(shard.path)
+                    .then(r => r.json())
+                    .then(records => {{
+                        records.forEach((record, i) => {{ spriteTable[shard.start + i] = record; }});
+                        shard.loaded = true;
+                    }});
+            }}
+            return shard.pending;
+        }}));
+}}
+
+// stubs stand in for sprite records until their shard arrives: sheet, size, preview cell and folder
+// are enough to lay out a scene and draw it from the preview atlas
+function fillStubs(node, sheets, stubs) {{
+    const [start, end] = node.oi;
+    for (let i = start; i < end; i++) {{
+        const o = i * 5;
+        spriteTable[i] = {{
+            stub: true, index: i, folder: node.path, ss: sheets[stubs[o]],
+            w: stubs[o + 1], h: stubs[o + 2], pv: [stubs[o + 3], stubs[o + 4]]
+        }};
+    }}
+    node.children.forEach(child => fillStubs(child, sheets, stubs));
+}}
+
+async function fullRecord(imgData) {{
+    // the sheet position (x/y or gif frames) only comes with the shard
+    if (!imgData.stub) return imgData;
+    await loadShards(imgData.index, imgData.index + 1);
+    return spriteTable[imgData.index];
+}}
+
+function lazyRange(node, key, table, ranges) {{
+    let resolved = null;
+    Object.defineProperty(node, key, {{
+        get() {{
+            if (resolved) return resolved;
+            const values = ranges.flatMap(([start, end]) => table.slice(start, end));
+            // don't cache holes or stubs from shards that haven't arrived yet
+            if (table !== spriteTable || ranges.every(([start, end]) => rangeLoaded(start, end))) resolved = values;
+            return values;
+        }},
+        enumerable: true,
+        configurable: true
+    }});
+}}
+
+function resolveRanges(node, texts) {{
+    node.aiRange = node.ai;
+    lazyRange(node, 'ai', spriteTable, [node.ai]);
+    lazyRange(node, 'oi', spriteTable, [node.oi]);
+    lazyRange(node, 'at', texts, node.at);
+    lazyRange(node, 'ot', texts, [node.ot]);
+    node.children.forEach(child => resolveRanges(child, texts));
+}}
+
+const DATA_FORMAT = '{DATA_FORMAT}';
+const NO_STRING = 0xFFFFFFFF;
+const NO_PREVIEW = 0xFFFF;
+const NODE_FIELDS = 15;
+
+// data.bin: typed-array views straight over the buffer, sprite records are only
+// materialised when a node's range is sliced
+function readBinaryData(buffer) {{
+    const header = new Uint32Array(buffer, 0, 8);
+    if (header[0] !== 0x31444741) throw new Error('data.bin: bad magic');
+    const [, nodeCount, spriteCount, stringCount, textCount, atCount, configIdx, frameCount] = header;
+    let offset = 32;
+    const take = (Type, count) => {{
+        const view = new Type(buffer, offset, count);
+        offset += Math.ceil(count * Type.BYTES_PER_ELEMENT / 4) * 4;
+        return view;
+    }};
+    const stringOffsets = take(Uint32Array, stringCount + 1);
+    const stringBytes = take(Uint8Array, stringOffsets[stringCount]);
+    const spriteSS = take(Uint32Array, spriteCount);
+    const spriteFrames = take(Uint32Array, spriteCount);
+    const spriteGI = take(Uint32Array, spriteCount);
+    const spritePath = take(Uint32Array, spriteCount);
+    const spriteX = take(Uint16Array, spriteCount);
+    const spriteY = take(Uint16Array, spriteCount);
+    const spriteW = take(Uint16Array, spriteCount);
+    const spriteH = take(Uint16Array, spriteCount);
+    const spriteFC = take(Uint16Array, spriteCount);
+    const spritePVX = take(Uint16Array, spriteCount);
+    const spritePVY = take(Uint16Array, spriteCount);
+    const textTable = take(Uint32Array, textCount);
+    const nodeRows = take(Uint32Array, nodeCount * NODE_FIELDS);
+    const atData = take(Uint32Array, atCount * 2);
+    const framePool = take(Uint16Array, frameCount * 2);
+
+    const decoder = new TextDecoder();
+    const strings = new Array(stringCount);
+    const str = i => {{
+        if (i === NO_STRING) return undefined;
+        if (strings[i] === undefined) strings[i] = decoder.decode(stringBytes.subarray(stringOffsets[i], stringOffsets[i + 1]));
+        return strings[i];
+    }};
+
+    const nodes = new Array(nodeCount);
+    for (let i = 0; i < nodeCount; i++) {{
+        const row = nodeRows.subarray(i * NODE_FIELDS, (i + 1) * NODE_FIELDS);
+        const at = [];
+        for (let r = row[13]; r < row[13] + row[14]; r++) at.push([atData[r * 2], atData[r * 2 + 1]]);
+        nodes[i] = {{
+            name: str(row[0]),
+            path: str(row[1]),
+            type: str(row[2]),
+            children: [],
+            ai: [row[7], row[8]],
+            at: at,
+            oi: [row[9], row[10]],
+            ot: [row[11], row[12]],
+            na: (row[4] & 1) !== 0,
+            sa: (row[4] & 2) !== 0
+        }};
+        if (row[3] !== NO_STRING) nodes[i].grid_layout = str(row[3]);
+    }}
+    for (let i = 0; i < nodeCount; i++) {{
+        const first = nodeRows[i * NODE_FIELDS + 5];
+        nodes[i].children = nodes.slice(first, first + nodeRows[i * NODE_FIELDS + 6]);
+    }}
+
+    const sprite = i => {{
+        const record = {{ ss: str(spriteSS[i]), gi: spriteGI[i], w: spriteW[i], h: spriteH[i], path: str(spritePath[i]) }};
+        if (spriteFC[i] > 0) {{
+            record.fr = [];
+            for (let f = spriteFrames[i]; f < spriteFrames[i] + spriteFC[i]; f++) record.fr.push([framePool[f * 2], framePool[f * 2 + 1]]);
+            record.anim = true;
+        }} else {{
+            record.x = spriteX[i];
+            record.y = spriteY[i];
+        }}
+        if (spritePVX[i] !== NO_PREVIEW) record.pv = [spritePVX[i], spritePVY[i]];
+        return record;
+    }};
+    const sprites = {{
+        length: spriteCount,
+        slice(start, end) {{
+            const out = [];
+            for (let i = start; i < end; i++) out.push(sprite(i));
+            return out;
+        }}
+    }};
+
+    return {{
+        tree: nodes[0],
+        sprites: sprites,
+        texts: Array.from(textTable, str),
+        sprite_config: JSON.parse(str(configIdx))
+    }};
+}}
+
+const dataPromise = DATA_FORMAT === 'binary'
+    ? fetch('data.bin').then(r => r.arrayBuffer()).then(readBinaryData)
+    : fetch('data.json').then(r => r.json());
+
+dataPromise
     .then(async d => {{
         dataTree = d.tree;
         spriteConfig = d.sprite_config;
+        if (d.shards) {{
+            spriteTable = new Array(d.sprite_count);
+            spriteShards = d.shards.map(([start, end, path]) => ({{ start, end, path, loaded: false, pending: null }}));
+            if (d.stubs) {{
+                fillStubs(dataTree, d.stub_sheets, d.stubs);
+                spriteStubs = true;
+            }}
+        }} else {{
+            spriteTable = d.sprites;
+        }}
+        resolveRanges(dataTree, d.texts);
         buildTree(dataTree, document.getElementById('tree'));
         
         progress = {{ss: 0, ssTotal: 0, stacks: 0, stacksTotal: 0, imgs: 0, imgsTotal: 0}};
         
-        await renderContent(dataTree);
+        // open a deep link directly, rendering the root first would fetch every shard
+        const hash = window.location.hash.slice(2);
+        const hashNode = hash ? findNodeByPath(dataTree, hash) : null;
+        await renderContent(hashNode || dataTree);
         
         isInitialLoad = false;
         const loaderEl = document.getElementById('loader');
         if (loaderEl) loaderEl.remove();
-        
-        const hash = window.location.hash.slice(2);
-        if (hash) {{
-            const node = findNodeByPath(dataTree, hash);
-            if (node) await renderContent(node);
-        }}
     }});
 
 window.addEventListener('hashchange', () => {{
@@ -578,14 +2486,113 @@ async function loadSpritesheet(path) {{
             texture.magFilter = THREE.NearestFilter;
             spritesheets[path] = texture;
             delete pendingLoads[path];
-            progress.ss++;
-            updateLoader();
             resolve(texture);
         }});
     }});
     return pendingLoads[path];
 }}
 
+function rectGeometry(baseGeometry, x, y, w, h, atlasWidth, atlasHeight) {{
+    const u_start = x / atlasWidth;
+    const u_end = (x + w) / atlasWidth;
+    const v_start = 1 - (y + h) / atlasHeight;
+    const v_end = 1 - y / atlasHeight;
+    const uvKey = `${{u_start.toFixed(6)}},${{u_end.toFixed(6)}},${{v_start.toFixed(6)}},${{v_end.toFixed(6)}}`;
+    if (!geometryCache[uvKey]) {{
+        const geometry = baseGeometry.clone();
+        const uvs = geometry.attributes.uv;
+        uvs.setXY(0, u_start, v_end);
+        uvs.setXY(1, u_end, v_end);
+        uvs.setXY(2, u_start, v_start);
+        uvs.setXY(3, u_end, v_start);
+        geometryCache[uvKey] = geometry;
+    }}
+    return geometryCache[uvKey];
+}}
+
+function sheetMaterial(path, texture) {{
+    if (!materialCache[path]) {{
+        materialCache[path] = new THREE.MeshBasicMaterial({{
+            map: texture,
+            side: THREE.DoubleSide,
+            transparent: true,
+            opacity: 1
+        }});
+    }}
+    return materialCache[path];
+}}
+
+async function loadPreview() {{
+    if (!spriteConfig.preview) return null;
+    const texture = await loadSpritesheet(spriteConfig.preview.path);
+    texture.magFilter = THREE.LinearFilter;
+    texture.needsUpdate = true;
+    return sheetMaterial(spriteConfig.preview.path, texture);
+}}
+
+function previewGeometry(imgData, baseGeometry) {{
+    const preview = spriteConfig.preview;
+    const scale = preview.size / spriteConfig.sprite_size;
+    const image = materialCache[preview.path].map.image;
+    return rectGeometry(baseGeometry, imgData.pv[0], imgData.pv[1],
+        Math.max(1, Math.round(imgData.w * scale)), Math.max(1, Math.round(imgData.h * scale)), image.width, image.height);
+}}
+
+function applySheet(mesh, imgData, baseGeometry) {{
+    const SPRITESHEET_SIZE = spriteConfig.spritesheet_size;
+    mesh.material = sheetMaterial(imgData.ss, spritesheets[variantPath(imgData.ss, sheetShown[imgData.ss])]);
+    if (imgData.anim) {{
+        mesh.userData = {{
+            imgData: imgData,
+            spritesheet: imgData.ss
+        }};
+        mesh.onBeforeRender = function() {{
+            const anim = this.userData.imgData;
+            const [x, y] = anim.fr[Math.floor(Date.now() / 100) % anim.fr.length];
+            const u_start = x / SPRITESHEET_SIZE;
+            const u_end = (x + anim.w) / SPRITESHEET_SIZE;
+            const v_start = 1 - (y + anim.h) / SPRITESHEET_SIZE;
+            const v_end = 1 - y / SPRITESHEET_SIZE;
+            const uvs = this.geometry.attributes.uv;
+            uvs.setXY(0, u_start, v_end);
+            uvs.setXY(1, u_end, v_end);
+            uvs.setXY(2, u_start, v_start);
+            uvs.setXY(3, u_end, v_start);
+            uvs.needsUpdate = true;
+        }};
+        mesh.geometry = baseGeometry.clone();
+    }} else {{
+        mesh.geometry = rectGeometry(baseGeometry, imgData.x, imgData.y, imgData.w, imgData.h, SPRITESHEET_SIZE, SPRITESHEET_SIZE);
+    }}
+}}
+
+function variantPath(ss, size) {{
+    return size >= spriteConfig.sprite_size ? ss : ss.replace(/(\.[^.]+)$/, `@${{size}}$1`);
+}}
+
+function sheetVariantFor(pixels) {{
+    // smallest sheet variant whose sprites are at least as large as they appear on screen
+    const sizes = (spriteConfig.sheet_variants || []).concat([spriteConfig.sprite_size]);
+    return sizes.find(size => size >= pixels) || spriteConfig.sprite_size;
+}}
+
+async function loadSheetVariant(ss, size) {{
+    // all variants share one material per sheet; a larger variant swaps its map in, a smaller one never replaces it
+    const texture = await loadSpritesheet(variantPath(ss, size));
+    if (sheetShown[ss] === undefined) {{
+        progress.ss++;
+        updateLoader();
+    }}
+    if (!(sheetShown[ss] >= size)) {{
+        sheetShown[ss] = size;
+        if (materialCache[ss]) {{
+            materialCache[ss].map = texture;
+            materialCache[ss].needsUpdate = true;
+        }}
+    }}
+    return spritesheets[variantPath(ss, sheetShown[ss])];
+}}
+
 
 async function createThreeScene(container, images, node) {{
     console.log('[createThreeScene] START for node:', node.name, 'images:', images.length);
@@ -611,8 +2618,8 @@ async function createThreeScene(container, images, node) {{
 
 
     images.forEach(imgData => {{
-        const parts = imgData.path.split('/');
-        const folder = parts.slice(0, -1).join('/') || 'root';
+        const folder = imgData.stub ? (imgData.folder === '.' ? 'root' : imgData.folder)
+            : imgData.path.split('/').slice(0, -1).join('/') || 'root';
         if (!grouped[folder]) grouped[folder] = [];
         grouped[folder].push(imgData);
     }});
@@ -626,10 +2633,11 @@ progress.imgsTotal += images.length;
 progress.stacksTotal += folders.length;
 const uniqueSS = new Set(images.map(i => i.ss));
 progress.ssTotal += uniqueSS.size;
-uniqueSS.forEach(ss => {{ if (spritesheets[ss]) progress.ss++; }});
+uniqueSS.forEach(ss => {{ if (sheetShown[ss] !== undefined) progress.ss++; }});
 updateLoader();
  
     const sharedGeometry = new THREE.PlaneGeometry(1, 1);
+    const previewMaterial = await loadPreview();
     
     const spacing = 1.5;
     let cols, rows, offsetX, offsetZ;
@@ -808,6 +2816,10 @@ updateLoader();
     const controls = new OrbitControls(camera, renderer.domElement);
     controls.enablePan = false;
 
+    // on-screen height of a 1.5 unit tall sprite in device pixels
+    const spriteScreenSize = () => 1.5 * container.clientHeight * window.devicePixelRatio * camera.zoom / (camera.top - camera.bottom);
+    let sheetSize = sheetVariantFor(spriteScreenSize());
+
     const navButtons = document.createElement('div');
     navButtons.style.position = 'absolute';
     navButtons.style.top = '5px';
@@ -950,19 +2962,10 @@ updateLoader();
 
                 for (let i = 0; i < stackImages.length; i++) {{
                     const imgData = stackImages[i];
-                    const texture = await loadSpritesheet(imgData.ss);
-                    if (!materialCache[imgData.ss]) {{
-                        materialCache[imgData.ss] = new THREE.MeshBasicMaterial({{
-                            map: texture,
-                            side: THREE.DoubleSide,
-                            transparent: true,
-                            opacity: 1
-                        }});
-                    }}
                     const aspect = imgData.w / imgData.h;
                     const height = 1.5;
                     const width = height * aspect;
-                    const mesh = new THREE.Mesh(sharedGeometry, materialCache[imgData.ss]);
+                    const mesh = new THREE.Mesh(sharedGeometry, previewMaterial);
                     mesh.scale.set(width, height, 1);
                     mesh.position.x = xPos;
                     mesh.position.y = i * STACK_SPACING;
@@ -970,47 +2973,13 @@ updateLoader();
                     mesh.rotation.x = Math.PI / 2;
                     mesh.rotation.y = Math.PI;
                     mesh.rotation.z = Math.PI;
-                    if (imgData.anim) {{
-                        mesh.userData = {{
-                            imgData: imgData,
-                            spritesheet: imgData.ss
-                        }};
-                        mesh.onBeforeRender = function() {{
-                            const frame = Math.floor(Date.now() / 100) % this.userData.imgData.fc;
-                            const idx = this.userData.imgData.si + frame;
-                            const sprite_col = idx % SPRITES_PER_ROW;
-                            const sprite_row = Math.floor(idx / SPRITES_PER_ROW);
-                            const u_start = (sprite_col * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const u_end = u_start + SPRITE_SIZE / SPRITESHEET_SIZE;
-                            const v_start = 1 - ((sprite_row + 1) * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const v_end = 1 - (sprite_row * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const uvs = this.geometry.attributes.uv;
-                            uvs.setXY(0, u_start, v_end);
-                            uvs.setXY(1, u_end, v_end);
-                            uvs.setXY(2, u_start, v_start);
-                            uvs.setXY(3, u_end, v_start);
-                            uvs.needsUpdate = true;
-                        }};
-                        mesh.geometry = sharedGeometry.clone();
+                    if (previewMaterial && sheetShown[imgData.ss] === undefined) {{
+                        // draw from the preview atlas now, swap in the sheet once it has loaded
+                        mesh.geometry = previewGeometry(imgData, sharedGeometry);
+                        loadSheetVariant(imgData.ss, sheetSize).then(() => fullRecord(imgData)).then(record => applySheet(mesh, record, sharedGeometry));
                     }} else {{
-                        const idx = imgData.idx;
-                        const sprite_col = idx % SPRITES_PER_ROW;
-                        const sprite_row = Math.floor(idx / SPRITES_PER_ROW);
-                        const u_start = (sprite_col * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                        const u_end = u_start + imgData.w / SPRITESHEET_SIZE;
-                        const v_start = 1 - ((sprite_row + 1) * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                        const v_end = 1 - (sprite_row * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                        const uvKey = `${{u_start.toFixed(6)}},${{u_end.toFixed(6)}},${{v_start.toFixed(6)}},${{v_end.toFixed(6)}}`;
-                        if (!geometryCache[uvKey]) {{
-                            const geometry = sharedGeometry.clone();
-                            const uvs = geometry.attributes.uv;
-                            uvs.setXY(0, u_start, v_end);
-                            uvs.setXY(1, u_end, v_end);
-                            uvs.setXY(2, u_start, v_start);
-                            uvs.setXY(3, u_end, v_start);
-                            geometryCache[uvKey] = geometry;
-                        }}
-                        mesh.geometry = geometryCache[uvKey];
+                        await loadSheetVariant(imgData.ss, sheetSize);
+                        applySheet(mesh, await fullRecord(imgData), sharedGeometry);
                     }}
                    
 scene.add(mesh);
@@ -1107,19 +3076,10 @@ await updateLoaderAsync();
 
                     for (let i = 0; i < stackImages.length; i++) {{
                         const imgData = stackImages[i];
-                        const texture = await loadSpritesheet(imgData.ss);
-                        if (!materialCache[imgData.ss]) {{
-                            materialCache[imgData.ss] = new THREE.MeshBasicMaterial({{
-                                map: texture,
-                                side: THREE.DoubleSide,
-                                transparent: true,
-                                opacity: 1
-                            }});
-                        }}
                         const aspect = imgData.w / imgData.h;
                         const height = 1.5;
                         const width = height * aspect;
-                        const mesh = new THREE.Mesh(sharedGeometry, materialCache[imgData.ss]);
+                        const mesh = new THREE.Mesh(sharedGeometry, previewMaterial);
                         mesh.scale.set(width, height, 1);
                         mesh.position.x = xPos;
                         mesh.position.y = i * STACK_SPACING;
@@ -1127,47 +3087,13 @@ await updateLoaderAsync();
                         mesh.rotation.x = Math.PI / 2;
                         mesh.rotation.y = Math.PI;
                         mesh.rotation.z = Math.PI;
-                        if (imgData.anim) {{
-                            mesh.userData = {{
-                                imgData: imgData,
-                                spritesheet: imgData.ss
-                            }};
-                            mesh.onBeforeRender = function() {{
-                                const frame = Math.floor(Date.now() / 100) % this.userData.imgData.fc;
-                                const idx = this.userData.imgData.si + frame;
-                                const sprite_col = idx % SPRITES_PER_ROW;
-                                const sprite_row = Math.floor(idx / SPRITES_PER_ROW);
-                                const u_start = (sprite_col * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                                const u_end = u_start + SPRITE_SIZE / SPRITESHEET_SIZE;
-                                const v_start = 1 - ((sprite_row + 1) * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                                const v_end = 1 - (sprite_row * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                                const uvs = this.geometry.attributes.uv;
-                                uvs.setXY(0, u_start, v_end);
-                                uvs.setXY(1, u_end, v_end);
-                                uvs.setXY(2, u_start, v_start);
-                                uvs.setXY(3, u_end, v_start);
-                                uvs.needsUpdate = true;
-                            }};
-                            mesh.geometry = sharedGeometry.clone();
+                        if (previewMaterial && sheetShown[imgData.ss] === undefined) {{
+                            // draw from the preview atlas now, swap in the sheet once it has loaded
+                            mesh.geometry = previewGeometry(imgData, sharedGeometry);
+                            loadSheetVariant(imgData.ss, sheetSize).then(() => fullRecord(imgData)).then(record => applySheet(mesh, record, sharedGeometry));
                         }} else {{
-                            const idx = imgData.idx;
-                            const sprite_col = idx % SPRITES_PER_ROW;
-                            const sprite_row = Math.floor(idx / SPRITES_PER_ROW);
-                            const u_start = (sprite_col * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const u_end = u_start + imgData.w / SPRITESHEET_SIZE;
-                            const v_start = 1 - ((sprite_row + 1) * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const v_end = 1 - (sprite_row * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const uvKey = `${{u_start.toFixed(6)}},${{u_end.toFixed(6)}},${{v_start.toFixed(6)}},${{v_end.toFixed(6)}}`;
-                            if (!geometryCache[uvKey]) {{
-                                const geometry = sharedGeometry.clone();
-                                const uvs = geometry.attributes.uv;
-                                uvs.setXY(0, u_start, v_end);
-                                uvs.setXY(1, u_end, v_end);
-                                uvs.setXY(2, u_start, v_start);
-                                uvs.setXY(3, u_end, v_start);
-                                geometryCache[uvKey] = geometry;
-                            }}
-                            mesh.geometry = geometryCache[uvKey];
+                            await loadSheetVariant(imgData.ss, sheetSize);
+                            applySheet(mesh, await fullRecord(imgData), sharedGeometry);
                         }}
                         
 scene.add(mesh);
@@ -1262,19 +3188,10 @@ await updateLoaderAsync();
 
                 for (let i = 0; i < stackImages.length; i++) {{
                     const imgData = stackImages[i];
-                    const texture = await loadSpritesheet(imgData.ss);
-                    if (!materialCache[imgData.ss]) {{
-                        materialCache[imgData.ss] = new THREE.MeshBasicMaterial({{
-                            map: texture,
-                            side: THREE.DoubleSide,
-                            transparent: true,
-                            opacity: 1
-                        }});
-                    }}
                     const aspect = imgData.w / imgData.h;
                     const height = 1.5;
                     const width = height * aspect;
-                    const mesh = new THREE.Mesh(sharedGeometry, materialCache[imgData.ss]);
+                    const mesh = new THREE.Mesh(sharedGeometry, previewMaterial);
                     mesh.scale.set(width, height, 1);
                     mesh.position.x = xPos;
                     mesh.position.y = i * STACK_SPACING;
@@ -1282,47 +3199,13 @@ await updateLoaderAsync();
                     mesh.rotation.x = Math.PI / 2;
                     mesh.rotation.y = Math.PI;
                     mesh.rotation.z = Math.PI;
-                    if (imgData.anim) {{
-                        mesh.userData = {{
-                            imgData: imgData,
-                            spritesheet: imgData.ss
-                        }};
-                        mesh.onBeforeRender = function() {{
-                            const frame = Math.floor(Date.now() / 100) % this.userData.imgData.fc;
-                            const idx = this.userData.imgData.si + frame;
-                            const sprite_col = idx % SPRITES_PER_ROW;
-                            const sprite_row = Math.floor(idx / SPRITES_PER_ROW);
-                            const u_start = (sprite_col * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const u_end = u_start + SPRITE_SIZE / SPRITESHEET_SIZE;
-                            const v_start = 1 - ((sprite_row + 1) * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const v_end = 1 - (sprite_row * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                            const uvs = this.geometry.attributes.uv;
-                            uvs.setXY(0, u_start, v_end);
-                            uvs.setXY(1, u_end, v_end);
-                            uvs.setXY(2, u_start, v_start);
-                            uvs.setXY(3, u_end, v_start);
-                            uvs.needsUpdate = true;
-                        }};
-                        mesh.geometry = sharedGeometry.clone();
+                    if (previewMaterial && sheetShown[imgData.ss] === undefined) {{
+                        // draw from the preview atlas now, swap in the sheet once it has loaded
+                        mesh.geometry = previewGeometry(imgData, sharedGeometry);
+                        loadSheetVariant(imgData.ss, sheetSize).then(() => fullRecord(imgData)).then(record => applySheet(mesh, record, sharedGeometry));
                     }} else {{
-                        const idx = imgData.idx;
-                        const sprite_col = idx % SPRITES_PER_ROW;
-                        const sprite_row = Math.floor(idx / SPRITES_PER_ROW);
-                        const u_start = (sprite_col * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                        const u_end = u_start + imgData.w / SPRITESHEET_SIZE;
-                        const v_start = 1 - ((sprite_row + 1) * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                        const v_end = 1 - (sprite_row * SPRITE_SIZE + SPRITE_PADDING) / SPRITESHEET_SIZE;
-                        const uvKey = `${{u_start.toFixed(6)}},${{u_end.toFixed(6)}},${{v_start.toFixed(6)}},${{v_end.toFixed(6)}}`;
-                        if (!geometryCache[uvKey]) {{
-                            const geometry = sharedGeometry.clone();
-                            const uvs = geometry.attributes.uv;
-                            uvs.setXY(0, u_start, v_end);
-                            uvs.setXY(1, u_end, v_end);
-                            uvs.setXY(2, u_start, v_start);
-                            uvs.setXY(3, u_end, v_start);
-                            geometryCache[uvKey] = geometry;
-                        }}
-                        mesh.geometry = geometryCache[uvKey];
+                        await loadSheetVariant(imgData.ss, sheetSize);
+                        applySheet(mesh, await fullRecord(imgData), sharedGeometry);
                     }}
 
 scene.add(mesh);
@@ -1436,6 +3319,14 @@ await updateLoaderAsync();
         const rotationAngle = Date.now() * ROTATION_SPEED;
         scene.rotation.y = rotationAngle;
         
+        if (frameCount % 30 === 0) {{
+            const wanted = sheetVariantFor(spriteScreenSize());
+            if (wanted > sheetSize) {{
+                sheetSize = wanted;
+                uniqueSS.forEach(ss => loadSheetVariant(ss, sheetSize));
+            }}
+        }}
+
         if (frameCount % 10 === 0) {{
             const raycaster = new THREE.Raycaster();
             raycaster.camera = camera;
@@ -1505,6 +3396,9 @@ let isInitialLoad = true;
 
 
 async function renderContent(node) {{
+    // with stubs the scenes start from the preview atlas and fetch shards per sprite as sheets load;
+    // without them every shard of the node has to be there, whatever an earlier view already loaded
+    if (!spriteStubs) await loadShards(...node.aiRange);
     if (!isInitialLoad) {{
         updateURL(node);
     }}
@@ -1728,6 +3622,23 @@ contentDiv.innerHTML = '';
 
 </script>
 </body>
-</html>''')
-
-print("Generated spritesheets, data.json and index.html")
+</html>'''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--watch', action='store_true', help='rebuild whenever the source tree changes')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='seconds between polls in watch mode')
+    parser.add_argument('--jobs', type=int, default=JOBS, help='processes used to decode, resize and filter images')
+    parser.add_argument('--plan', action='store_true', help='print the sheets and slots a build would produce from image headers only')
+    args = parser.parse_args()
+
+    # a single build doesn't need its worker pool or decoded sprites afterwards, and finished workers show up
+    # in the report's cpu time
+    with Builder(jobs=args.jobs, keep_pool=args.watch, keep_warm=args.watch) as builder:
+        if args.plan:
+            builder.plan()
+        elif args.watch:
+            watch(builder, args.interval)
+        else:
+            builder.build()
+            print("Generated spritesheets, data.json and index.html")